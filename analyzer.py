@@ -25,25 +25,28 @@
 # along with this source code. If not, see <http://www.gnu.org/licenses/>.
 # --------------------------------------------------------------
 
-import os, logging, time, csv
+import os, logging, time, csv, math, hashlib, json, pickle, shutil
 from enum import Enum
 from datetime import datetime
 import mysql.connector as mysql
 import networkx as nx
 import pandas as pd
 import numpy as np
+import scipy.sparse as sp
 from matplotlib import pyplot as plt
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import instrumentation
 
 import stellargraph as sg
 import tensorflow as tf
 from stellargraph import StellarDiGraph
 from stellargraph.utils import plot_history
-from stellargraph.mapper import CorruptedGenerator, FullBatchNodeGenerator
-from stellargraph.layer import GCN, DeepGraphInfomax
+from stellargraph.mapper import CorruptedGenerator, FullBatchNodeGenerator, ClusterNodeGenerator, GraphSAGENodeGenerator
+from stellargraph.layer import GCN, GraphSAGE, DeepGraphInfomax
 from tensorflow.keras import layers, optimizers, losses, Model
 from tensorflow.keras.optimizers import Adam
-from tensorflow.keras.callbacks import EarlyStopping
+from tensorflow.keras.callbacks import EarlyStopping, Callback
 from sklearn import model_selection
 from sklearn.linear_model import LogisticRegression
 
@@ -53,21 +56,63 @@ logging.basicConfig(format='%(asctime)s.%(msecs)06d: %(message)s', level=logging
 
 # Execution paths.
 OUTPUT_FOLDER = 'Executions/'
+EMBEDDINGS_FOLDER = 'Embeddings/'
+FEATURES_FOLDER = 'Features/'
 TRANSACTIONS_CSV_FILE = 'Generated_Files/transactions.csv'
-EXCHANGES_ADDRESSES_CSV_FILE = 'Generated_Files/exchanges_addresses.csv'
-GAMBLING_ADDRESSES_CSV_FILE = 'Generated_Files/gambling_addresses.csv'
-HISTORIC_ADDRESSES_CSV_FILE = 'Generated_Files/historic_addresses.csv'
-MALICIOUS_ADDRESSES_CSV_FILE = 'Generated_Files/malicious_addresses.csv'
-MINING_ADDRESSES_CSV_FILE = 'Generated_Files/mining_addresses.csv'
-SERVICES_ADDRESSES_CSV_FILE = 'Generated_Files/services_addresses.csv'
+LABEL_INDEX_FILE = 'Generated_Files/label_index.npz'
 
 # Database queries used to retrieve the dataset.
 TXIN_QUERY = 'SELECT t3.address, t1.txid, t1.timestamp, t3.value FROM btc.tx t1 JOIN btc.txin t2 ON (t1.txid = t2.consume_txid) JOIN btc.txout t3 ON (t2.output_txid = t3.output_txid AND t2.vout = t3.vout) WHERE t1.txid in '
 TXOUT_QUERY = 'SELECT t1.txid, t2.address, t1.timestamp, t2.value FROM btc.tx t1 JOIN btc.txout t2 ON (t1.txid = t2.output_txid) WHERE t1.txid in '
+ADDRESS_TXIN_QUERY = 'SELECT DISTINCT(t1.txid) FROM btc.tx t1 JOIN btc.txin t2 ON (t1.txid = t2.consume_txid) JOIN btc.txout t3 ON (t2.output_txid = t3.output_txid AND t2.vout = t3.vout) WHERE t3.address IN '
+ADDRESS_TXOUT_QUERY = 'SELECT DISTINCT(t1.txid) FROM btc.tx t1 JOIN btc.txout t2 ON (t1.txid = t2.output_txid) WHERE t2.address IN '
+QUERY_BATCH_SIZE = 100000 # records fetched and converted to graph data per batch
 
 # Machine Learning execution parameters.
 FOLDS = 10
+FOLD_WORKERS = min(FOLDS, os.cpu_count() or 1) # threads evaluating folds concurrently
 EPOCHS = 500
+LAYER_SIZES = [128]
+
+# Node embeddings engine: 'dgi' or 'sgc'.
+# On 'dgi', embeddings are learned by the Deep Graph Infomax model, while on 'sgc' the training-free
+# SGC/SIGN propagated features(node features propagated over SGC_HOPS hops) are used instead, as a fast baseline.
+EMBEDDING_ENGINE = 'dgi'
+SGC_HOPS = [0, 1, 2, 3] # propagation hops k of the concatenated Â^k·X features
+
+# Deep Graph Infomax training mode: 'auto', 'fullbatch', 'cluster_gcn' or 'graphsage'.
+# On 'auto', sparse full-batch training is used when its estimated memory fits in MEMORY_BUDGET,
+# otherwise the model is trained in Cluster-GCN mini-batches sized to the budget.
+TRAINING_MODE = 'auto'
+MEMORY_BUDGET = 8 * 1024 ** 3 # bytes
+CLUSTER_GCN_Q = 4 # clusters combined in each mini-batch
+GRAPHSAGE_BATCH_SIZE = 1000
+GRAPHSAGE_NUM_SAMPLES = [10] # neighbours sampled per layer of LAYER_SIZES
+
+# Address clustering configuration.
+# Addresses spent together as inputs of a transaction are assumed to be controlled by the same entity(common-input-ownership heuristic),
+# so each cluster is collapsed into a single entity node, before computing the node features.
+ADDRESS_CLUSTERING = False
+
+# Temporal mode configuration.
+# Graph edges are sliced in time windows of WINDOW_SIZE seconds, starting every WINDOW_STEP seconds.
+# Equal size and step produce tumbling windows, while a smaller step produces sliding windows.
+# Each window model is warm-started from the previous window model weights.
+TEMPORAL_MODE = False
+WINDOW_SIZE = 365 * 24 * 60 * 60 # seconds
+WINDOW_STEP = 365 * 24 * 60 * 60 # seconds
+
+# Scoring mode configuration.
+# Addresses of the scoring file are classified in batches, using the model files of a previous execution folder.
+# Each address neighbourhood subgraph(its transactions and their addresses) is retrieved from the Database.
+SCORING_MODE = False
+SCORING_EXECUTION_FOLDER = 'Executions/{execution folder}/'
+SCORING_ADDRESSES_CSV_FILE = 'Generated_Files/scoring_addresses.csv'
+SCORING_BATCH_SIZE = 10000
+
+# Node features computed from the graph edges.
+# Node flags are labels and must never be part of the features.
+NODE_FEATURES = ['type', 'in_degree', 'out_degree', 'in_value', 'out_value', 'mean_in_value', 'mean_out_value', 'first_timestamp', 'last_timestamp', 'activity_span', 'in_counterparts', 'out_counterparts']
 
 # Utility classes used for mapping node types and flags to integers.
 class Node_Type(Enum):
@@ -105,17 +150,21 @@ def read_csv_file(file):
 	#logging.info('Records: ' + str(records))
 	return records
 
+# Loads the label index file generated by transactions_retriever.py,
+# containing the sorted hashes of all labeled addresses and their flag.
+def read_label_index_file(file):
+	logging.info('Retrieving label index from: ' + file)
+	with np.load(file) as label_index_file:
+		label_index = {'hashes':label_index_file['hashes'], 'flags':label_index_file['categories']}
+	logging.info('Indexed addresses: ' + str(len(label_index['hashes'])))
+	return label_index
+
 # Parse each execution file and build the execution records dictionary, used for labeling graph nodes.
 def retrieve_execution_records():
 	logging.info('Retrieving execution records...')
 	transactions = read_csv_file(TRANSACTIONS_CSV_FILE)
-	exchanges_addresses = read_csv_file(EXCHANGES_ADDRESSES_CSV_FILE)
-	gambling_addresses = read_csv_file(GAMBLING_ADDRESSES_CSV_FILE)
-	historic_addresses = read_csv_file(HISTORIC_ADDRESSES_CSV_FILE)
-	malicious_addresses = read_csv_file(MALICIOUS_ADDRESSES_CSV_FILE)
-	mining_addresses = read_csv_file(MINING_ADDRESSES_CSV_FILE)
-	services_addresses = read_csv_file(SERVICES_ADDRESSES_CSV_FILE)
-	execution_records_dict = {'transactions':transactions, 'exchanges_addresses':exchanges_addresses, 'gambling_addresses':gambling_addresses, 'historic_addresses':historic_addresses, 'malicious_addresses':malicious_addresses, 'mining_addresses':mining_addresses, 'services_addresses':services_addresses}
+	label_index = read_label_index_file(LABEL_INDEX_FILE)
+	execution_records_dict = {'transactions':transactions, 'label_index':label_index}
 	logging.info('Execution records retrieved!')
 	return execution_records_dict
 
@@ -139,63 +188,60 @@ def close_database(db, cursor):
 		db.close()
 	logging.info('Database connection closed!')
 
-# For a given address, identify its flag from the execution records dictionary.
-def retrieve_address_flag(execution_records_dict, address):
-	flag = Node_Flag.UNKNOWN.value
-	if address in execution_records_dict['exchanges_addresses']:
-		flag = Node_Flag.EXCHANGES.value
-	elif address in execution_records_dict['gambling_addresses']:
-		flag = Node_Flag.GAMBLING.value
-	elif address in execution_records_dict['historic_addresses']:
-		flag = Node_Flag.HISTORIC.value
-	elif address in execution_records_dict['malicious_addresses']:
-		flag = Node_Flag.MALICIOUS.value
-	elif address in execution_records_dict['mining_addresses']:
-		flag = Node_Flag.MINING.value
-	elif address in execution_records_dict['services_addresses']:
-		flag = Node_Flag.SERVICES.value
-	return flag
+# For a given addresses batch, identify their flags from the label index, using a single vectorized lookup.
+def retrieve_address_flags(label_index, addresses):
+	flags = np.full(len(addresses), Node_Flag.UNKNOWN.value, dtype=np.int8)
+	if len(addresses) == 0 or len(label_index['hashes']) == 0:
+		return flags
+	hashes = pd.util.hash_array(np.array(addresses, dtype=object))
+	positions = np.minimum(np.searchsorted(label_index['hashes'], hashes), len(label_index['hashes']) - 1)
+	found = label_index['hashes'][positions] == hashes
+	flags[found] = label_index['flags'][positions[found]]
+	return flags
+
+# Convert a batch of query records to networkx graph nodes and edges.
+# Each record is a (source, target, timestamp, value) tuple, where address_position denotes the address field.
+def add_records_to_graph(execution_records_dict, graph, addresses, transactions, records, address_position):
+	transaction_position = 1 - address_position
+	new_addresses = list(dict.fromkeys(record[address_position] for record in records if record[address_position] not in addresses))
+	flags = retrieve_address_flags(execution_records_dict['label_index'], new_addresses)
+	graph.add_nodes_from((address, {'type':Node_Type.ADDRESS.value, 'flag':int(flag)}) for address, flag in zip(new_addresses, flags))
+	addresses.update(new_addresses)
+	new_transactions = list(dict.fromkeys(record[transaction_position] for record in records if record[transaction_position] not in transactions))
+	graph.add_nodes_from(new_transactions, type=Node_Type.TRANSACTION.value, flag=Node_Flag.TRANSACTION.value)
+	transactions.update(new_transactions)
+	graph.add_edges_from((record[0], record[1], {'weight':record[3], 'timestamp':datetime.timestamp(record[2])}) for record in records)
+
+# Execute given query and convert retrieved data to networkx graph nodes, in batches of QUERY_BATCH_SIZE records.
+def execute_graph_query(cursor, execution_records_dict, graph, addresses, transactions, query, address_position):
+	with instrumentation.Stage('execute_graph_query', address_position=address_position) as stage:
+		cursor.execute(query + str(execution_records_dict['transactions']).replace('{','(').replace('}',')'))
+		count = 0
+		records = cursor.fetchmany(QUERY_BATCH_SIZE)
+		while records:
+			add_records_to_graph(execution_records_dict, graph, addresses, transactions, records, address_position)
+			count += len(records)
+			records = cursor.fetchmany(QUERY_BATCH_SIZE)
+		stage.add(rows=count)
+	return count
 
 # Execute TXIN_QUERY and convert retrieved data to networkx graph nodes.
 def execute_txin_query(cursor, execution_records_dict, graph, addresses, transactions):
 	logging.info('Fetching TXIN records and converting to graph data...')
-	txin_query = TXIN_QUERY + str(execution_records_dict['transactions']).replace('{','(').replace('}',')')
-	cursor.execute(txin_query)
-	count = 0
-	for result in cursor:		
-		if result[0] not in addresses:
-			flag = retrieve_address_flag(execution_records_dict, result[0])
-			graph.add_node(result[0], type=Node_Type.ADDRESS.value, flag=flag)
-			addresses.add(result[0])
-		if result[1] not in transactions:
-			graph.add_node(result[1], type=Node_Type.TRANSACTION.value, flag=Node_Flag.TRANSACTION.value)
-			transactions.add(result[1])
-		graph.add_edge(result[0], result[1], weight=result[3], timestamp=datetime.timestamp(result[2]))
-		count += 1
+	count = execute_graph_query(cursor, execution_records_dict, graph, addresses, transactions, TXIN_QUERY, 0)
 	logging.info('Finished TXIN records retriaval (' + str(count) + ') and conversion!')
 
 # Execute TXOUT_QUERY and convert retrieved data to networkx graph nodes.	
 def execute_txout_query(cursor, execution_records_dict, graph, addresses, transactions):
 	logging.info('Fetching TXOUT records and converting to graph data...')
-	txout_query = TXOUT_QUERY + str(execution_records_dict['transactions']).replace('{','(').replace('}',')')
-	cursor.execute(txout_query)
-	count = 0
-	for result in cursor:		
-		if result[0] not in transactions:
-			graph.add_node(result[0], type=Node_Type.TRANSACTION.value, flag=Node_Flag.TRANSACTION.value)
-			transactions.add(result[0])
-		if result[1] not in addresses:
-			flag = retrieve_address_flag(execution_records_dict, result[1])
-			graph.add_node(result[1], type=Node_Type.ADDRESS.value, flag=flag)
-			addresses.add(result[1])
-		graph.add_edge(result[0], result[1], weight=result[3], timestamp=datetime.timestamp(result[2]))
-		count += 1
+	count = execute_graph_query(cursor, execution_records_dict, graph, addresses, transactions, TXOUT_QUERY, 1)
 	logging.info('Finished TXOUT records retriaval (' + str(count) + ') and conversion!')
 
 # A networkx graph is created using the DB queries retrieved records,
-# graphml file is extracted for further visualization in external tools, 
-# and then the graph is converted to a StellarGraph object, used by the ML task.
-def generate_graph(execution_records_dict):
+# and graphml file is extracted for further visualization in external tools.
+# Graph node labels and edge matrix are returned, with addresses collapsed to entities when clustering is enabled,
+# in which case the address to entity map is extracted to a file, used by the scoring mode.
+def retrieve_graph(execution_records_dict):
 	logging.info('Generating graph...')
 	db = init_database()
 	cursor = db.cursor()
@@ -206,126 +252,758 @@ def generate_graph(execution_records_dict):
 	execute_txout_query(cursor, execution_records_dict, graph, addresses, transactions)
 	close_database(db, cursor)
 	logging.info('Generating graph file...')
-	nx.write_graphml_xml(graph, OUTPUT_FOLDER + 'graph.graphml')  
-	logging.info('Graph file gemerated! Generating StellarGraph object...')
-	graph_dict = dict(graph.nodes())
+	with instrumentation.Stage('write_graph_file', nodes=graph.number_of_nodes(), edges=graph.number_of_edges()):
+		nx.write_graphml_xml(graph, OUTPUT_FOLDER + 'graph.graphml')  
+	logging.info('Graph file gemerated!')
+	node_labels = pd.DataFrame.from_dict(dict(graph.nodes()), orient='index')
 	edge_matrix = nx.to_pandas_edgelist(graph)
-	stellar_graph = StellarDiGraph(pd.DataFrame.from_dict(graph_dict, orient='index'), edge_matrix, dtype='float32')
+	if ADDRESS_CLUSTERING:
+		node_labels, edge_matrix, entities = cluster_addresses(node_labels, edge_matrix)
+		entities.rename_axis('address').rename('entity').to_csv(OUTPUT_FOLDER + 'address_entity_map.csv', header=True)
+	return node_labels, edge_matrix
+
+# Class implementing a union-find forest over integer-interned nodes, using path compression and union by rank.
+class Union_Find:
+	def __init__(self, size):
+		self.parent = list(range(size))
+		self.rank = [0] * size
+
+	def find(self, node):
+		root = node
+		while self.parent[root] != root:
+			root = self.parent[root]
+		while self.parent[node] != root:
+			self.parent[node], node = root, self.parent[node]
+		return root
+
+	def union(self, first, second):
+		first = self.find(first)
+		second = self.find(second)
+		if first == second:
+			return
+		if self.rank[first] < self.rank[second]:
+			first, second = second, first
+		self.parent[second] = first
+		if self.rank[first] == self.rank[second]:
+			self.rank[first] += 1
+
+# Clusters the graph addresses using the common-input-ownership heuristic over the TXIN edges.
+# Each cluster is collapsed into an entity node, identified by its root address, and parallel edges are aggregated
+# by summing their values and keeping their earliest timestamp. Entity flag is the majority flag of its labelled addresses.
+# Collapsed node labels and edge matrix are returned, along with the address to entity map.
+@instrumentation.timed()
+def cluster_addresses(node_labels, edge_matrix):
+	logging.info('Clustering addresses...')
+	is_address = node_labels['type'] == Node_Type.ADDRESS.value
+	addresses = node_labels.index[is_address]
+	txin_edges = edge_matrix.loc[is_address.reindex(edge_matrix['source']).values, ['source', 'target']]
+	codes = addresses.get_indexer(txin_edges['source'])
+	first_codes = pd.Series(codes).groupby(txin_edges['target'].values).transform('first').values
+	union_find = Union_Find(len(addresses))
+	for first, second in set(zip(first_codes[codes != first_codes], codes[codes != first_codes])):
+		union_find.union(first, second)
+	entities = pd.Series(addresses[[union_find.find(code) for code in range(len(addresses))]], index=addresses)
+	# Entity flag propagation from its labelled addresses.
+	address_flags = node_labels.loc[is_address, 'flag']
+	known = address_flags != Node_Flag.UNKNOWN.value
+	entity_flags = pd.DataFrame({'entity':entities[known].values, 'flag':address_flags[known].values}).groupby('entity')['flag'].agg(lambda flags: flags.value_counts().idxmax())
+	entity_labels = pd.DataFrame({'type':Node_Type.ADDRESS.value, 'flag':Node_Flag.UNKNOWN.value}, index=pd.Index(entities.unique()))
+	entity_labels.loc[entity_flags.index, 'flag'] = entity_flags
+	node_labels = pd.concat([entity_labels, node_labels.loc[~is_address]])
+	node_map = entities.to_dict()
+	edge_matrix = edge_matrix.assign(source=edge_matrix['source'].map(lambda node: node_map.get(node, node)), target=edge_matrix['target'].map(lambda node: node_map.get(node, node)))
+	edge_matrix = edge_matrix.groupby(['source', 'target'], as_index=False, sort=False).agg({'weight':'sum', 'timestamp':'min'})
+	logging.info('Addresses clustered! Addresses: ' + str(len(addresses)) + ', entities: ' + str(len(entity_labels)) + ', edges: ' + str(len(edge_matrix)))
+	return node_labels, edge_matrix, entities
+
+# Given the graph node labels and edge matrix, the graph is converted to a StellarGraph object, used by the ML task.
+# Node features are retrieved from the features cache, unless cache_features is disabled(e.g. for single use window graphs).
+@instrumentation.timed()
+def generate_stellar_graph(node_labels, edge_matrix, cache_features=True):
+	nodes_matrix, scaling = retrieve_node_features(node_labels, edge_matrix) if cache_features else compute_node_features(node_labels, edge_matrix)
+	logging.info('Generating StellarGraph object...')
+	stellar_graph = StellarDiGraph(nodes_matrix, edge_matrix, dtype='float32')
 	logging.info(stellar_graph.info())
-	node_flags = pd.DataFrame.from_dict(graph.nodes, orient='index')['flag']
-	logging.info(Counter(node_flags))
+	graph_hash = compute_graph_hash(nodes_matrix, edge_matrix)
+	logging.info('Graph hash: ' + graph_hash)
 	logging.info('StellarGraph generated!')
-	return stellar_graph, node_flags
+	return stellar_graph, graph_hash, scaling
+
+# Retrieve the graph from the Database and convert it to a StellarGraph object, along with its node flags.
+def generate_graph(execution_records_dict):
+	node_labels, edge_matrix = retrieve_graph(execution_records_dict)
+	stellar_graph, graph_hash, scaling = generate_stellar_graph(node_labels, edge_matrix)
+	node_flags = node_labels['flag']
+	logging.info(Counter(node_flags))
+	return stellar_graph, node_flags, graph_hash, scaling
+
+# Computes the features of each node, using vectorized group-bys over the edge matrix.
+# Address counterparts are the distinct addresses on the other side of the address transactions,
+# while transaction counterparts are their distinct input and output addresses.
+# Heavy-tailed counts and values are log-scaled, and all features are standardized.
+# Standardization uses the given scaling(features mean and std), or the graph own one, which is also returned.
+@instrumentation.timed()
+def compute_node_features(node_labels, edge_matrix, scaling=None):
+	logging.info('Computing node features...')
+	features = pd.DataFrame(index=node_labels.index)
+	features['type'] = node_labels['type']
+	incoming = edge_matrix.groupby('target')
+	outgoing = edge_matrix.groupby('source')
+	features['in_degree'] = incoming.size()
+	features['out_degree'] = outgoing.size()
+	features['in_value'] = incoming['weight'].sum()
+	features['out_value'] = outgoing['weight'].sum()
+	features['mean_in_value'] = incoming['weight'].mean()
+	features['mean_out_value'] = outgoing['weight'].mean()
+	timestamps = pd.concat([edge_matrix[['source', 'timestamp']].rename(columns={'source': 'node'}), edge_matrix[['target', 'timestamp']].rename(columns={'target': 'node'})]).groupby('node')['timestamp']
+	features['first_timestamp'] = timestamps.min()
+	features['last_timestamp'] = timestamps.max()
+	features['activity_span'] = features['last_timestamp'] - features['first_timestamp']
+	# Address to address pairs, connected through a transaction.
+	is_txin = (node_labels['type'] == Node_Type.ADDRESS.value).reindex(edge_matrix['source']).values
+	txin_edges = edge_matrix.loc[is_txin, ['source', 'target']].rename(columns={'source': 'sender', 'target': 'transaction'})
+	txout_edges = edge_matrix.loc[~is_txin, ['source', 'target']].rename(columns={'source': 'transaction', 'target': 'receiver'})
+	counterparts = txin_edges.merge(txout_edges, on='transaction')[['sender', 'receiver']].drop_duplicates()
+	features['out_counterparts'] = counterparts.groupby('sender').size()
+	features['in_counterparts'] = counterparts.groupby('receiver').size()
+	is_transaction = features['type'] == Node_Type.TRANSACTION.value
+	features.loc[is_transaction, 'in_counterparts'] = features.loc[is_transaction, 'in_degree']
+	features.loc[is_transaction, 'out_counterparts'] = features.loc[is_transaction, 'out_degree']
+	features = features[NODE_FEATURES].fillna(0).astype('float64')
+	log_scaled = ['in_degree', 'out_degree', 'in_value', 'out_value', 'mean_in_value', 'mean_out_value', 'in_counterparts', 'out_counterparts']
+	features[log_scaled] = np.log1p(features[log_scaled])
+	if scaling is None:
+		scaling = pd.DataFrame({'mean':features.mean(), 'std':features.std().replace(0, 1)})
+	features = (features - scaling['mean']) / scaling['std']
+	logging.info('Node features computed!')
+	return features, scaling
+
+# Retrieve the node features from the features cache, computing and caching them when not present.
+# The cache is keyed by the hash of the node types, the graph edges and the feature names.
+def retrieve_node_features(node_labels, edge_matrix):
+	features_hash = hashlib.sha256()
+	features_hash.update(compute_graph_hash(node_labels[['type']], edge_matrix).encode())
+	features_hash.update(json.dumps(NODE_FEATURES).encode())
+	features_file = FEATURES_FOLDER + features_hash.hexdigest() + '_node_features_scaling.pkl'
+	if os.path.exists(features_file):
+		logging.info('Node features found in cache: ' + features_file)
+		return pd.read_pickle(features_file)
+	features, scaling = compute_node_features(node_labels, edge_matrix)
+	os.makedirs(FEATURES_FOLDER, exist_ok=True)
+	pd.to_pickle((features, scaling), features_file + '.tmp')
+	os.replace(features_file + '.tmp', features_file)
+	logging.info('Node features cached to: ' + features_file)
+	return features, scaling
+
+# Generates a hash of the graph nodes, their features and its edges, used to identify the graph in the embeddings store.
+def compute_graph_hash(nodes_matrix, edge_matrix):
+	graph_hash = hashlib.sha256()
+	graph_hash.update(pd.util.hash_pandas_object(nodes_matrix, index=True).values.tobytes())
+	graph_hash.update(pd.util.hash_pandas_object(edge_matrix, index=False).values.tobytes())
+	return graph_hash.hexdigest()
+
+# Keras callback recording the wall time of each training epoch.
+# Resident memory is sampled at the start of training and at the end of each epoch,
+# so the training memory is reported separately from the process peak memory.
+class Epoch_Timer(Callback):
+	def on_train_begin(self, logs=None):
+		self.epoch_times = []
+		self.start_memory = instrumentation.current_memory()
+		self.peak_memory = self.start_memory
+
+	def on_epoch_begin(self, epoch, logs=None):
+		self.epoch_start = time.time()
+
+	def on_epoch_end(self, epoch, logs=None):
+		self.epoch_times.append(time.time() - self.epoch_start)
+		self.peak_memory = max(self.peak_memory, instrumentation.current_memory())
+
+# Rough estimation of the sparse full-batch training memory:
+# clean and corrupted feature matrices, the sparse normalized adjacency(indices and values),
+# and the layer activations of both branches along with their gradients.
+def estimate_fullbatch_memory(stellar_graph):
+	nodes = stellar_graph.number_of_nodes()
+	edges = stellar_graph.number_of_edges()
+	features = sum(stellar_graph.node_feature_sizes().values())
+	features_memory = 2 * nodes * features * 4
+	adjacency_memory = (edges + nodes) * (2 * 8 + 4)
+	activations_memory = 2 * 3 * nodes * sum(LAYER_SIZES) * 4
+	return features_memory + adjacency_memory + activations_memory
+
+# Select the training mode of the Deep Graph Infomax model, based on the graph size and the memory budget.
+def select_training_mode(stellar_graph):
+	estimated_memory = estimate_fullbatch_memory(stellar_graph)
+	logging.info('Estimated full-batch training memory: ' + str(estimated_memory) + ' bytes (budget: ' + str(MEMORY_BUDGET) + ' bytes)')
+	if TRAINING_MODE != 'auto':
+		return TRAINING_MODE, estimated_memory
+	if estimated_memory <= MEMORY_BUDGET:
+		return 'fullbatch', estimated_memory
+	return 'cluster_gcn', estimated_memory
+
+# Create the data generator and base model of the selected training mode.
+# Full-batch mode uses the sparse adjacency matrix, as the dense one grows quadratically with the number of nodes.
+# Cluster-GCN mode splits the nodes into clusters, so that CLUSTER_GCN_Q of them fit in the memory budget.
+def create_base_model(stellar_graph, training_mode, estimated_memory):
+	activations = ['relu'] * len(LAYER_SIZES)
+	if training_mode == 'fullbatch':
+		generator = FullBatchNodeGenerator(stellar_graph, sparse=True)
+		base_model = GCN(layer_sizes=LAYER_SIZES, activations=activations, generator=generator)
+	elif training_mode == 'cluster_gcn':
+		clusters = max(CLUSTER_GCN_Q, math.ceil(estimated_memory * CLUSTER_GCN_Q / MEMORY_BUDGET))
+		logging.info('Cluster-GCN clusters: ' + str(clusters) + ', clusters per batch: ' + str(CLUSTER_GCN_Q))
+		generator = ClusterNodeGenerator(stellar_graph, clusters=clusters, q=CLUSTER_GCN_Q)
+		base_model = GCN(layer_sizes=LAYER_SIZES, activations=activations, generator=generator)
+	elif training_mode == 'graphsage':
+		generator = GraphSAGENodeGenerator(stellar_graph, batch_size=GRAPHSAGE_BATCH_SIZE, num_samples=GRAPHSAGE_NUM_SAMPLES)
+		base_model = GraphSAGE(layer_sizes=LAYER_SIZES, activations=activations, generator=generator)
+	else:
+		raise ValueError('Unknown training mode: ' + training_mode)
+	return generator, base_model
+
+# Create the node embeddings model of a base model.
+def create_embedding_model(generator, base_model):
+	x_emb_in, x_emb_out = base_model.in_out_tensors()
+	# Full-batch and Cluster-GCN models output a batch dimension of size 1.
+	if generator.num_batch_dims() == 2:
+		x_emb_out = tf.squeeze(x_emb_out, axis=0)
+	return Model(inputs=x_emb_in, outputs=x_emb_out)
 
 # Given a StellarGraph object, DeepInfomax + GCN node repsentation learing(features) task is performed.
-def deep_graph_infomax(stellar_graph):
+# When initial weights are given, the model is warm-started from them.
+# Trained model weights are also returned, while result files are prefixed with output_prefix.
+def deep_graph_infomax(stellar_graph, initial_weights=None, output_prefix=''):
 	logging.info('Generating Deep Graph Infomax model for node represation learning...')
+	training_mode, estimated_memory = select_training_mode(stellar_graph)
+	logging.info('Training mode: ' + training_mode)
 
 	logging.info('Creating data generators...')
-	fullbatch_generator = FullBatchNodeGenerator(stellar_graph, sparse=False)
-	corrupted_generator = CorruptedGenerator(fullbatch_generator)
+	generator, base_model = create_base_model(stellar_graph, training_mode, estimated_memory)
+	corrupted_generator = CorruptedGenerator(generator)
 	gen = corrupted_generator.flow(stellar_graph.nodes())
 	logging.info('Data generators created!')
 	
-	logging.info('Creating DeepGraphInfomax + GCN model...')
-	gcn_model = GCN(layer_sizes=[128], activations=["relu"], generator=fullbatch_generator)
-	infomax = DeepGraphInfomax(gcn_model, corrupted_generator)
+	logging.info('Creating DeepGraphInfomax model...')
+	infomax = DeepGraphInfomax(base_model, corrupted_generator)
 	x_in, x_out = infomax.in_out_tensors()
 	model = Model(inputs=x_in, outputs=x_out)
 	model.compile(loss=tf.nn.sigmoid_cross_entropy_with_logits, optimizer=Adam(lr=1e-3))
-	logging.info('DeepGraphInfomax + GCN model created!')
+	if initial_weights is not None:
+		logging.info('Warm-starting model from initial weights...')
+		model.set_weights(initial_weights)
+	logging.info('DeepGraphInfomax model created!')
 	
 	logging.info('Training generated model to learn node representations...')
 	es = EarlyStopping(monitor="loss", min_delta=0, patience=20)
-	history = model.fit(gen, epochs=EPOCHS, verbose=0, callbacks=[es])
+	epoch_timer = Epoch_Timer()
+	with instrumentation.Stage('train_model', training_mode=training_mode, nodes=stellar_graph.number_of_nodes(), edges=stellar_graph.number_of_edges()) as stage:
+		history = model.fit(gen, epochs=EPOCHS, verbose=0, callbacks=[es, epoch_timer])
+		stage.fields['epochs'] = len(epoch_timer.epoch_times)
 	logging.info('Generated model trained!')
 	
+	# Extract training statistics to a file.
+	statistics = 'Training statistics:' + '\nTraining mode: ' + training_mode + '\nNodes: ' + str(stellar_graph.number_of_nodes()) + '\nEdges: ' + str(stellar_graph.number_of_edges()) + '\nEstimated full-batch memory: ' + str(estimated_memory) + ' bytes' + '\nEpochs: ' + str(len(epoch_timer.epoch_times)) + '\nMean epoch time: ' + str(np.mean(epoch_timer.epoch_times)) + ' seconds' + '\nTotal training time: ' + str(np.sum(epoch_timer.epoch_times)) + ' seconds' + '\nTraining start memory: ' + str(epoch_timer.start_memory) + ' bytes' + '\nTraining peak memory(sampled per epoch): ' + str(epoch_timer.peak_memory) + ' bytes' + '\nProcess peak memory: ' + str(instrumentation.peak_memory()) + ' bytes'
+	logging.info(statistics)
+	with open(OUTPUT_FOLDER + output_prefix + 'training_statistics.txt', "w") as output_file:
+		output_file.write(statistics)
+	
 	logging.info('Generating history plot file...')
 	plot_history(history)
-	plt.savefig(OUTPUT_FOLDER + 'history.png')
+	plt.savefig(OUTPUT_FOLDER + output_prefix + 'history.png')
+	plt.close('all')
 	logging.info('History plot file gemerated!')
 	
 	logging.info('Extracting Embeddings...')
-	x_emb_in, x_emb_out = gcn_model.in_out_tensors()
-	x_out = tf.squeeze(x_emb_out, axis=0)
-	emb_model = Model(inputs=x_emb_in, outputs=x_out)
+	emb_model = create_embedding_model(generator, base_model)
 	logging.info('Embeddings extracted!')
 
 	logging.info('Deep Graph Infomax model generated!')
-	return fullbatch_generator, emb_model
+	return generator, emb_model, model.get_weights()
+
+# Predict the embeddings of given nodes, in the same order as the nodes.
+# Cluster-GCN flows yield their nodes grouped by cluster, so predictions are reordered using the flow node order.
+@instrumentation.timed()
+def predict_embeddings(generator, model, node_ids):
+	flow = generator.flow(node_ids)
+	embeddings = model.predict(flow)
+	if isinstance(generator, ClusterNodeGenerator):
+		embeddings = pd.DataFrame(embeddings, index=flow.node_order).loc[node_ids].values
+	return embeddings
+
+# Computes the SGC/SIGN propagated features of a StellarGraph object, without any training.
+# Node features X are propagated over the symmetric normalized adjacency with self-loops Â = D^-1/2·(A + I)·D^-1/2,
+# ignoring edge directions, and Â^k·X is concatenated for each k of given hops.
+# Propagated features and their node ids are returned.
+@instrumentation.timed()
+def propagate_features(stellar_graph, hops):
+	node_ids = stellar_graph.nodes()
+	adjacency = stellar_graph.to_adjacency_matrix(node_ids)
+	adjacency = ((adjacency + adjacency.T + sp.identity(len(node_ids), format='csr')) > 0).astype('float32')
+	normalization = sp.diags(1 / np.sqrt(np.asarray(adjacency.sum(axis=1)).ravel()))
+	adjacency = (normalization @ adjacency @ normalization).tocsr()
+	features = stellar_graph.node_features(node_ids).astype('float32')
+	propagated = []
+	for k in range(max(hops) + 1):
+		if k > 0:
+			features = adjacency @ features
+		if k in hops:
+			propagated.append(features)
+	return np.hstack(propagated), node_ids
 
-# Given the features model of Graph, a classification task is performed using Logistic Regression.
-def train_and_avaluate(generator, model, train_subjects, test_subjects):
+# Computes the SGC/SIGN propagated features of a StellarGraph object, used as node embeddings,
+# extracting the propagation statistics to a file.
+def sgc_embeddings(stellar_graph, output_prefix=''):
+	logging.info('Computing SGC propagated features for node represation...')
+	start_memory = instrumentation.current_memory()
+	propagation_time = time.time()
+	embeddings, node_ids = propagate_features(stellar_graph, SGC_HOPS)
+	propagation_time = time.time() - propagation_time
+	end_memory = instrumentation.current_memory()
+	statistics = 'Training statistics:' + '\nEmbedding engine: sgc' + '\nHops: ' + str(SGC_HOPS) + '\nNodes: ' + str(stellar_graph.number_of_nodes()) + '\nEdges: ' + str(stellar_graph.number_of_edges()) + '\nTotal propagation time: ' + str(propagation_time) + ' seconds' + '\nPropagation start memory: ' + str(start_memory) + ' bytes' + '\nPropagation end memory: ' + str(end_memory) + ' bytes' + '\nProcess peak memory: ' + str(instrumentation.peak_memory()) + ' bytes'
+	logging.info(statistics)
+	with open(OUTPUT_FOLDER + output_prefix + 'training_statistics.txt', "w") as output_file:
+		output_file.write(statistics)
+	logging.info('SGC propagated features computed!')
+	return embeddings, node_ids
+
+# Generates the embeddings store key of a graph, combining its hash with the model configuration.
+# Classifier parameters are not part of the key, so the stored embeddings are reused across classifiers.
+def embeddings_store_key(graph_hash):
+	if EMBEDDING_ENGINE == 'sgc':
+		model_configuration = {'embedding_engine': EMBEDDING_ENGINE, 'sgc_hops': SGC_HOPS}
+	else:
+		model_configuration = {'training_mode': TRAINING_MODE, 'layer_sizes': LAYER_SIZES, 'epochs': EPOCHS, 'memory_budget': MEMORY_BUDGET, 'cluster_gcn_q': CLUSTER_GCN_Q, 'graphsage_batch_size': GRAPHSAGE_BATCH_SIZE, 'graphsage_num_samples': GRAPHSAGE_NUM_SAMPLES}
+	key = hashlib.sha256()
+	key.update(graph_hash.encode())
+	key.update(json.dumps(model_configuration, sort_keys=True).encode())
+	return key.hexdigest()
+
+# Writes an array, or a list of arrays, to the embeddings store.
+# A temporary file is used, so that interrupted executions never leave partial store files.
+def write_store_file(file, array):
+	with open(file + '.tmp', 'wb') as output_file:
+		if isinstance(array, list):
+			np.savez(output_file, *array)
+		else:
+			np.save(output_file, array)
+	os.replace(file + '.tmp', file)
+
+# Retrieve all node embeddings from the embeddings store.
+# In case they are not present, the Deep Graph Infomax model is trained and all node embeddings
+# are computed once and stored, along with the node ids of each row, the encoder weights and its configuration.
+# On 'sgc' engine, the propagated features are stored instead, along with the propagation configuration.
+# Embeddings are loaded memory-mapped, so folds only read the rows they use.
+# The store key is also returned.
+def retrieve_embeddings(stellar_graph, graph_hash):
+	logging.info('Retrieving node embeddings...')
+	key = embeddings_store_key(graph_hash)
+	embeddings_file = EMBEDDINGS_FOLDER + key + '_embeddings.npy'
+	nodes_file = EMBEDDINGS_FOLDER + key + '_nodes.npy'
+	encoder_weights_file = EMBEDDINGS_FOLDER + key + '_encoder_weights.npz'
+	encoder_file = EMBEDDINGS_FOLDER + key + '_encoder.json'
+	store_files = [embeddings_file, nodes_file, encoder_file] + ([encoder_weights_file] if EMBEDDING_ENGINE == 'dgi' else [])
+	if all(os.path.exists(file) for file in store_files):
+		logging.info('Embeddings found in store, skipping model training!')
+	elif EMBEDDING_ENGINE == 'sgc':
+		logging.info('Embeddings not found in store.')
+		embeddings, node_ids = sgc_embeddings(stellar_graph)
+		os.makedirs(EMBEDDINGS_FOLDER, exist_ok=True)
+		with open(encoder_file, 'w') as output_file:
+			json.dump({'model':'sgc', 'sgc_hops':SGC_HOPS}, output_file)
+		write_store_file(nodes_file, np.array(node_ids, dtype=str))
+		write_store_file(embeddings_file, embeddings)
+		logging.info('Node embeddings stored!')
+	else:
+		logging.info('Embeddings not found in store.')
+		generator, model, weights = deep_graph_infomax(stellar_graph)
+		logging.info('Computing all node embeddings...')
+		node_ids = stellar_graph.nodes()
+		embeddings = predict_embeddings(generator, model, node_ids).astype('float32')
+		os.makedirs(EMBEDDINGS_FOLDER, exist_ok=True)
+		encoder = {'model':'graphsage' if isinstance(generator, GraphSAGENodeGenerator) else 'gcn', 'layer_sizes':LAYER_SIZES, 'graphsage_batch_size':GRAPHSAGE_BATCH_SIZE, 'graphsage_num_samples':GRAPHSAGE_NUM_SAMPLES}
+		with open(encoder_file, 'w') as output_file:
+			json.dump(encoder, output_file)
+		write_store_file(encoder_weights_file, model.get_weights())
+		write_store_file(nodes_file, np.array(node_ids, dtype=str))
+		write_store_file(embeddings_file, embeddings)
+		logging.info('Node embeddings stored!')
+	embeddings = np.load(embeddings_file, mmap_mode='r')
+	node_index = pd.Index(np.load(nodes_file))
+	logging.info('Node embeddings retrieved from: ' + embeddings_file)
+	return embeddings, node_index, key
+
+# Given the node embeddings, a classification task is performed using Logistic Regression.
+# Classifier fit and predict times, along with the fitted classifier, are also returned.
+def train_and_avaluate(train_embeddings, test_embeddings, train_subjects, test_subjects):
 	logging.info('Training classifier and performing predictions using Logistic Regression...')
-	train_gen = generator.flow(train_subjects.index)
-	test_gen = generator.flow(test_subjects.index)
-	train_embeddings = model.predict(train_gen)
-	test_embeddings = model.predict(test_gen)	
 	lr = LogisticRegression(multi_class="auto", solver="lbfgs", max_iter=500)
+	fit_time = time.time()
 	lr.fit(train_embeddings, train_subjects)
+	fit_time = time.time() - fit_time
+	predict_time = time.time()
 	y_pred = lr.predict(test_embeddings)
+	predict_time = time.time() - predict_time
 	gcn_acc = (y_pred == test_subjects).mean()
 	logging.info('Test classification accuracy: ' + str(gcn_acc))	
-	return gcn_acc, y_pred
-
-# Given a StellarGraph object and its node flags set:
-# 	1. Create the node represation model.
-#	2. Genarate k-folds for evaluation
-#	3. Train and evaluate each fold.
-#	4. Extract each fold predictions to a file.
-#	5. Extract execution statistics to a file.
-#	6. Extract best fold predictions to a file.
-def execute_graph_ML(stellar_graph, node_flags):
-	logging.info('Executing graph Machine Learning using StellarGraph Deep Graph Infomax + GCN algorithm...')
-	
-	# Generating Deep Graph Infomax model.
-	generator, model = deep_graph_infomax(stellar_graph)
-	
+	return gcn_acc, y_pred, fit_time, predict_time, lr
+
+# Train and evaluate a single fold, slicing its train and test embeddings from the shared read-only embeddings.
+def evaluate_fold(i, embeddings, node_rows, node_flags, train_subjects, test_subjects):
+	logging.info('Training and evaluating on fold ' + str(i) + '...')
+	train_embeddings = embeddings[node_rows[train_subjects]]
+	test_embeddings = embeddings[node_rows[test_subjects]]
+	return train_and_avaluate(train_embeddings, test_embeddings, node_flags.iloc[train_subjects], node_flags.iloc[test_subjects])
+
+# Given the node embeddings, their row of each node and the node flags set:
+#	1. Genarate k-folds for evaluation
+#	2. Train and evaluate each fold, using a pool of FOLD_WORKERS threads.
+#	3. Extract each fold predictions to a file.
+#	4. Extract execution statistics to a file.
+#	5. Extract best fold predictions to a file.
+# Result files are prefixed with output_prefix, while fold accuracies and the best fold classifier are returned.
+@instrumentation.timed()
+def evaluate_folds(embeddings, node_rows, node_flags, output_prefix=''):
 	# Generating k-folds.
 	logging.info('Generating ' + str(FOLDS) + ' folds...')
-	folds = model_selection.StratifiedShuffleSplit(n_splits=FOLDS, test_size=0.3, random_state=42).split(node_flags, node_flags)
+	folds = list(model_selection.StratifiedShuffleSplit(n_splits=FOLDS, test_size=0.3, random_state=42).split(node_flags, node_flags))
 	logging.info('Folds generated!')
 	
-	# Train and evaluate each fold.
+	# Train and evaluate each fold concurrently.
+	# Results are collected in fold order, so the best fold and statistics are deterministic.
+	logging.info('Evaluating folds using ' + str(FOLD_WORKERS) + ' workers...')
+	with ThreadPoolExecutor(max_workers=FOLD_WORKERS) as executor:
+		futures = [executor.submit(evaluate_fold, i, embeddings, node_rows, node_flags, train_subjects, test_subjects) for i, (train_subjects, test_subjects) in enumerate(folds)]
+		results = [future.result() for future in futures]
+	
 	accuracies = []
+	fold_timings = ''
 	best_fold = 0
 	best_accuracy = 0
 	best_fold_predictions = None
 	best_fold_test_subjects = None
-	for i, (train_subjects, test_subjects) in enumerate(folds):
-		logging.info('Training and evaluating on fold ' + str(i) + '...')
-		acc, pred = train_and_avaluate(generator, model, node_flags[train_subjects], node_flags[test_subjects])
+	best_fold_classifier = None
+	for i, ((train_subjects, test_subjects), (acc, pred, fit_time, predict_time, classifier)) in enumerate(zip(folds, results)):
 		# Extract fold predictions to a file.
-		df = pd.DataFrame({"Predicted": pred, "True": node_flags[test_subjects]})
-		df.to_csv(OUTPUT_FOLDER + 'fold_' + str(i) + '_predictions.csv', sep=',')
+		df = pd.DataFrame({"Predicted": pred, "True": node_flags.iloc[test_subjects]})
+		df.to_csv(OUTPUT_FOLDER + output_prefix + 'fold_' + str(i) + '_predictions.csv', sep=',')
 		accuracies.append(acc)
+		fold_timings += '\nFold ' + str(i) + ': accuracy ' + str(acc) + ', fit time ' + str(fit_time) + ' seconds, predict time ' + str(predict_time) + ' seconds'
 		# Best fold check.
 		if acc > best_accuracy:
 			best_fold = i
 			best_accuracy = acc
 			best_fold_predictions = pred
-			best_fold_test_subjects = node_flags[test_subjects]
+			best_fold_test_subjects = node_flags.iloc[test_subjects]
+			best_fold_classifier = classifier
 	
 	# Extract execution statistics to a file.
-	statistics = 'K-Fold validation statistics:' + '\nBest fold: ' + str(best_fold) + '\nBest accuracy: ' + str(best_accuracy) + '\nMean accuracy: ' + str(np.mean(accuracies)) + '\nStandard deviation: ' + str(np.std(accuracies))
+	statistics = 'K-Fold validation statistics:' + '\nBest fold: ' + str(best_fold) + '\nBest accuracy: ' + str(best_accuracy) + '\nMean accuracy: ' + str(np.mean(accuracies)) + '\nStandard deviation: ' + str(np.std(accuracies)) + '\nFold workers: ' + str(FOLD_WORKERS) + fold_timings
 	logging.info(statistics)
-	with open(OUTPUT_FOLDER + 'classification_statistics.txt', "w") as output_file:
+	with open(OUTPUT_FOLDER + output_prefix + 'classification_statistics.txt', "w") as output_file:
 		output_file.write(statistics)
 	# Extract best fold predictions to a file.
 	df = pd.DataFrame({"Predicted": best_fold_predictions, "True": best_fold_test_subjects})
-	df.to_csv(OUTPUT_FOLDER + 'best_fold_predictions.csv', sep=',')
+	df.to_csv(OUTPUT_FOLDER + output_prefix + 'best_fold_predictions.csv', sep=',')
+	return accuracies, best_fold_classifier
+
+# Persist the execution model files, used by the scoring mode:
+# the encoder weights(not present on 'sgc' engine) and configuration, the node ids of the stored embeddings rows(graph id mapping),
+# the node features scaling and the best fold classifier.
+# On clustered executions, the address to entity map of the execution folder is also part of the model files.
+def persist_model(store_key, scaling, classifier):
+	logging.info('Persisting model files...')
+	if os.path.exists(EMBEDDINGS_FOLDER + store_key + '_encoder_weights.npz'):
+		shutil.copyfile(EMBEDDINGS_FOLDER + store_key + '_encoder_weights.npz', OUTPUT_FOLDER + 'encoder_weights.npz')
+	shutil.copyfile(EMBEDDINGS_FOLDER + store_key + '_nodes.npy', OUTPUT_FOLDER + 'nodes.npy')
+	with open(EMBEDDINGS_FOLDER + store_key + '_encoder.json') as encoder_file:
+		encoder = json.load(encoder_file)
+	encoder['embeddings_file'] = EMBEDDINGS_FOLDER + store_key + '_embeddings.npy'
+	encoder['address_clustering'] = ADDRESS_CLUSTERING
+	if ADDRESS_CLUSTERING and not os.path.exists(OUTPUT_FOLDER + 'address_entity_map.csv'):
+		raise FileNotFoundError('Address to entity map not found in: ' + OUTPUT_FOLDER)
+	with open(OUTPUT_FOLDER + 'encoder.json', 'w') as output_file:
+		json.dump(encoder, output_file)
+	scaling.to_csv(OUTPUT_FOLDER + 'feature_scaling.csv', sep=',')
+	with open(OUTPUT_FOLDER + 'classifier.pkl', 'wb') as output_file:
+		pickle.dump(classifier, output_file)
+	logging.info('Model files persisted!')
+
+# Given a StellarGraph object, its node flags set, its hash and its node features scaling:
+# 	1. Retrieve the node embeddings from the store or create the node represation model(or the propagated features).
+#	2. Evaluate the node embeddings using k-folds.
+#	3. Persist the model files for scoring.
+def execute_graph_ML(stellar_graph, node_flags, graph_hash, scaling):
+	logging.info('Executing graph Machine Learning using ' + EMBEDDING_ENGINE + ' embedding engine...')
+	
+	# Retrieving node embeddings, generating the Deep Graph Infomax model(or the propagated features) when they are not stored.
+	embeddings, node_index, store_key = retrieve_embeddings(stellar_graph, graph_hash)
+	node_rows = node_index.get_indexer(node_flags.index)
+	accuracies, classifier = evaluate_folds(embeddings, node_rows, node_flags)
+	persist_model(store_key, scaling, classifier)
+
+# Update the window graph incrementally, adding the edges entering the window and expiring the ones leaving it.
+# Expired edges endpoints left without edges are removed from the window graph.
+def update_window_graph(window_graph, edge_matrix, added_edges, expired_edges):
+	expired = edge_matrix.iloc[expired_edges]
+	window_graph.remove_edges_from(zip(expired['source'], expired['target']))
+	endpoints = set(expired['source']).union(expired['target'])
+	window_graph.remove_nodes_from([node for node in endpoints if window_graph.degree(node) == 0])
+	added = edge_matrix.iloc[added_edges]
+	window_graph.add_edges_from((source, target, {'weight':weight, 'timestamp':timestamp}) for source, target, weight, timestamp in zip(added['source'], added['target'], added['weight'], added['timestamp']))
+
+# Given the window node flags, keep only the flags evaluable with k-folds(at least two nodes per flag).
+def evaluable_node_flags(node_flags):
+	flag_counts = node_flags.value_counts()
+	return node_flags[node_flags.isin(flag_counts[flag_counts >= 2].index)]
+
+# Given the graph node labels and edge matrix, temporal graph Machine Learning is executed:
+#	1. Sort graph edges by timestamp and generate the time windows.
+#	2. For each window, update the window graph incrementally from the previous window.
+#	3. Train the window Deep Graph Infomax model, warm-started from the previous window model weights(or compute its propagated features).
+#	4. Extract window node embeddings to a file and evaluate them using k-folds.
+#	5. Extract temporal statistics to a file.
+def execute_temporal_graph_ML(node_labels, edge_matrix):
+	logging.info('Executing temporal graph Machine Learning using ' + EMBEDDING_ENGINE + ' embedding engine...')
+	edge_matrix = edge_matrix.sort_values('timestamp', kind='stable').reset_index(drop=True)
+	timestamps = edge_matrix['timestamp'].values
+	window_starts = np.arange(timestamps[0], timestamps[-1] + 1, WINDOW_STEP)
+	logging.info('Time windows generated: ' + str(len(window_starts)))
+	
+	window_graph = nx.DiGraph()
+	window_start_edge = 0
+	window_end_edge = 0
+	weights = None
+	temporal_statistics = []
+	for i, window_start in enumerate(window_starts):
+		window_end = window_start + WINDOW_SIZE
+		logging.info('Processing window ' + str(i) + ': ' + str(datetime.fromtimestamp(window_start)) + ' - ' + str(datetime.fromtimestamp(window_end)))
+		start_edge = np.searchsorted(timestamps, window_start, side='left')
+		end_edge = np.searchsorted(timestamps, window_end, side='left')
+		expired_edges = np.arange(window_start_edge, min(start_edge, window_end_edge))
+		added_edges = np.arange(max(window_end_edge, start_edge), end_edge)
+		update_window_graph(window_graph, edge_matrix, added_edges, expired_edges)
+		window_start_edge = start_edge
+		window_end_edge = end_edge
+		logging.info('Window edges added: ' + str(len(added_edges)) + ', expired: ' + str(len(expired_edges)))
+		if window_graph.number_of_edges() == 0:
+			logging.info('Window has no edges, skipping...')
+			continue
+		
+		output_prefix = 'window_' + str(i) + '_'
+		window_node_labels = node_labels.loc[list(window_graph.nodes())]
+		stellar_graph, graph_hash, scaling = generate_stellar_graph(window_node_labels, nx.to_pandas_edgelist(window_graph), cache_features=False)
+		training_time = time.time()
+		if EMBEDDING_ENGINE == 'sgc':
+			embeddings, node_ids = sgc_embeddings(stellar_graph, output_prefix)
+			training_time = time.time() - training_time
+		else:
+			generator, model, weights = deep_graph_infomax(stellar_graph, weights, output_prefix)
+			training_time = time.time() - training_time
+			node_ids = stellar_graph.nodes()
+			embeddings = predict_embeddings(generator, model, node_ids).astype('float32')
+			tf.keras.backend.clear_session()
+		np.save(OUTPUT_FOLDER + output_prefix + 'embeddings.npy', embeddings)
+		np.save(OUTPUT_FOLDER + output_prefix + 'nodes.npy', np.array(node_ids, dtype=str))
+		
+		node_flags = evaluable_node_flags(window_node_labels['flag'])
+		accuracies = []
+		if node_flags.nunique() >= 2:
+			accuracies, classifier = evaluate_folds(embeddings, pd.Index(node_ids).get_indexer(node_flags.index), node_flags, output_prefix)
+		else:
+			logging.info('Window has less than two evaluable flags, skipping evaluation...')
+		temporal_statistics.append({'window':i, 'start':datetime.fromtimestamp(window_start), 'end':datetime.fromtimestamp(window_end), 'nodes':stellar_graph.number_of_nodes(), 'edges':stellar_graph.number_of_edges(), 'added_edges':len(added_edges), 'expired_edges':len(expired_edges), 'training_time':training_time, 'mean_accuracy':np.mean(accuracies) if accuracies else np.nan, 'accuracy_std':np.std(accuracies) if accuracies else np.nan})
+	
+	# Extract temporal statistics to a file.
+	df = pd.DataFrame(temporal_statistics)
+	logging.info('Temporal statistics:\n' + df.to_string())
+	df.to_csv(OUTPUT_FOLDER + 'temporal_statistics.csv', sep=',', index=False)
+
+# Loads the model files of an execution folder, used by the scoring mode.
+# Stored embeddings are loaded memory-mapped, when still present in the embeddings store,
+# along with the address to entity map of clustered executions.
+def load_model(execution_folder):
+	logging.info('Loading model files from: ' + execution_folder)
+	with open(execution_folder + 'encoder.json') as encoder_file:
+		encoder = json.load(encoder_file)
+	encoder_weights = None
+	if encoder['model'] != 'sgc':
+		if encoder['layer_sizes'] != LAYER_SIZES or encoder['graphsage_num_samples'] != GRAPHSAGE_NUM_SAMPLES:
+			raise ValueError('Execution encoder configuration differs from current configuration: ' + str(encoder))
+		with np.load(execution_folder + 'encoder_weights.npz') as weights_file:
+			encoder_weights = [weights_file['arr_' + str(i)] for i in range(len(weights_file.files))]
+	scaling = pd.read_csv(execution_folder + 'feature_scaling.csv', index_col=0)
+	with open(execution_folder + 'classifier.pkl', 'rb') as classifier_file:
+		classifier = pickle.load(classifier_file)
+	embeddings = None
+	node_index = pd.Index([])
+	if os.path.exists(encoder['embeddings_file']):
+		embeddings = np.load(encoder['embeddings_file'], mmap_mode='r')
+		node_index = pd.Index(np.load(execution_folder + 'nodes.npy'))
+	entity_map = {}
+	if encoder.get('address_clustering'):
+		entity_map = pd.read_csv(execution_folder + 'address_entity_map.csv', index_col=0)['entity'].to_dict()
+	logging.info('Model files loaded! Stored embeddings: ' + str(len(node_index)) + ', mapped addresses: ' + str(len(entity_map)))
+	return {'encoder':encoder, 'encoder_weights':encoder_weights, 'scaling':scaling, 'classifier':classifier, 'embeddings':embeddings, 'node_index':node_index, 'entity_map':entity_map}
+
+# Read the addresses of the scoring file, de-duplicated in file order, so batches are identical across runs.
+def read_scoring_addresses(file):
+	logging.info('Retrieving scoring addresses from csv: ' + file)
+	with open(file) as csv_file:
+		csv_reader = csv.reader(csv_file)
+		header = next(csv_reader)
+		addresses = list(dict.fromkeys(row[0] for row in csv_reader))
+	logging.info('Scoring addresses retrieved: ' + str(len(addresses)))
+	return addresses
+
+# Retrieve the neighbourhood subgraph of given addresses from the Database, covering given hops with complete node edges.
+# On each round, all transactions of the frontier addresses are retrieved, along with their input and output addresses,
+# which form the next round frontier. Each round expands the subgraph by two hops(address -> transaction -> address),
+# and nodes features are complete once all their counterparts are retrieved, so hops // 2 + 1 rounds are executed.
+# Subgraph node labels and edge matrix are returned.
+def retrieve_neighbourhood_graph(cursor, label_index, addresses, hops):
+	graph = nx.DiGraph()
+	graph_addresses = set()
+	graph_transactions = set()
+	frontier = set(addresses)
+	for i in range(hops // 2 + 1):
+		frontier_list = str(list(frontier)).replace('[','(').replace(']',')')
+		transactions = set()
+		for query in [ADDRESS_TXIN_QUERY, ADDRESS_TXOUT_QUERY]:
+			cursor.execute(query + frontier_list)
+			transactions.update(result[0] for result in cursor)
+		transactions.difference_update(graph_transactions)
+		if not transactions:
+			break
+		previous_addresses = set(graph_addresses)
+		neighbourhood_records_dict = {'transactions':transactions, 'label_index':label_index}
+		execute_txin_query(cursor, neighbourhood_records_dict, graph, graph_addresses, graph_transactions)
+		execute_txout_query(cursor, neighbourhood_records_dict, graph, graph_addresses, graph_transactions)
+		frontier = graph_addresses - previous_addresses
+		if not frontier:
+			break
+	node_labels = pd.DataFrame.from_dict(dict(graph.nodes()), orient='index')
+	edge_matrix = nx.to_pandas_edgelist(graph)
+	return node_labels, edge_matrix
+
+# Resolve the subgraph address clusters to the execution entities, using the persisted address to entity map.
+# A subgraph cluster containing addresses of execution entities is resolved to the entity with most such addresses.
+# Series mapping each subgraph address to its execution entity is returned, missing for unresolved clusters.
+def resolve_execution_entities(entities, entity_map):
+	execution_entities = pd.Series([entity_map.get(address) for address in entities.index], index=entities.index, dtype=object)
+	known = execution_entities.notna()
+	resolved = execution_entities[known].groupby(entities[known].values).agg(lambda clusters: clusters.value_counts().idxmax())
+	return entities.map(resolved)
+
+# Compute the embeddings of given addresses, using the persisted encoder over their neighbourhood subgraph,
+# covering the encoder layers hops(or the propagation hops on 'sgc' models). Subgraph features are standardized using the execution features scaling.
+# GCN encoders trained in Cluster-GCN mode share their weights with full-batch mode, used for the subgraphs.
+# On 'sgc' models, the subgraph propagated features are used instead.
+# On clustered models, the subgraph addresses are clustered the same way and unioned with the persisted map:
+# addresses co-spending with addresses of an execution entity get its stored embedding. Remaining addresses get
+# their subgraph entity embedding, which is approximate, as the subgraph only includes part of the entity transactions.
+# Embeddings of addresses not found in the Database are not returned.
+def compute_address_embeddings(cursor, label_index, model, addresses):
+	hops = max(model['encoder']['sgc_hops']) if model['encoder']['model'] == 'sgc' else len(model['encoder']['layer_sizes'])
+	node_labels, edge_matrix = retrieve_neighbourhood_graph(cursor, label_index, addresses, hops)
+	addresses = [address for address in addresses if address in node_labels.index]
+	if not addresses:
+		return pd.DataFrame()
+	nodes = addresses
+	address_embeddings = []
+	if model['encoder'].get('address_clustering'):
+		node_labels, edge_matrix, entities = cluster_addresses(node_labels, edge_matrix)
+		rows = model['node_index'].get_indexer(resolve_execution_entities(entities, model['entity_map']).loc[addresses].fillna(''))
+		resolved = [address for address, row in zip(addresses, rows) if row >= 0]
+		if resolved:
+			address_embeddings.append(pd.DataFrame(model['embeddings'][rows[rows >= 0]], index=resolved))
+		logging.info('Addresses resolved to execution entities: ' + str(len(resolved)) + ', approximated: ' + str(len(addresses) - len(resolved)))
+		addresses = [address for address, row in zip(addresses, rows) if row < 0]
+		if not addresses:
+			return pd.concat(address_embeddings)
+		nodes = list(entities.loc[addresses])
+	features = compute_node_features(node_labels, edge_matrix, model['scaling'])[0]
+	stellar_graph = StellarDiGraph(features, edge_matrix, dtype='float32')
+	if model['encoder']['model'] == 'sgc':
+		embeddings, node_ids = propagate_features(stellar_graph, model['encoder']['sgc_hops'])
+		address_embeddings.append(pd.DataFrame(pd.DataFrame(embeddings, index=node_ids).loc[nodes].values, index=addresses))
+		return pd.concat(address_embeddings)
+	training_mode = 'graphsage' if model['encoder']['model'] == 'graphsage' else 'fullbatch'
+	generator, base_model = create_base_model(stellar_graph, training_mode, None)
+	emb_model = create_embedding_model(generator, base_model)
+	emb_model.set_weights(model['encoder_weights'])
+	embeddings = predict_embeddings(generator, emb_model, pd.Index(nodes))
+	tf.keras.backend.clear_session()
+	address_embeddings.append(pd.DataFrame(embeddings, index=addresses))
+	return pd.concat(address_embeddings)
+
+# Classify the addresses of the scoring file in batches of SCORING_BATCH_SIZE, using the model files of SCORING_EXECUTION_FOLDER.
+# Model files are loaded once, while each address embedding is retrieved from:
+#	1. The embeddings store, for nodes of the execution graph(or their entity nodes on clustered executions).
+#	2. The scoring cache, for addresses already scored in previous batches.
+#	3. The persisted encoder, applied to the neighbourhood subgraph of the remaining batch addresses.
+# Class probabilities of each batch are appended to the predictions file, along with the batch latency to the statistics file.
+def score_addresses():
+	logging.info('Scoring addresses using the model files of: ' + SCORING_EXECUTION_FOLDER)
+	model = load_model(SCORING_EXECUTION_FOLDER)
+	classifier = model['classifier']
+	flag_names = [Node_Flag(flag).name for flag in classifier.classes_]
+	label_index = read_label_index_file(LABEL_INDEX_FILE)
+	addresses = read_scoring_addresses(SCORING_ADDRESSES_CSV_FILE)
+	db = init_database()
+	cursor = db.cursor()
+	scoring_cache = {}
+	statistics = 'Scoring statistics:'
+	for i, batch_start in enumerate(range(0, len(addresses), SCORING_BATCH_SIZE)):
+		batch = addresses[batch_start:batch_start + SCORING_BATCH_SIZE]
+		logging.info('Scoring batch ' + str(i) + '(' + str(len(batch)) + ' addresses)...')
+		batch_time = time.time()
+		with instrumentation.Stage('score_batch', batch=i) as stage:
+			rows = model['node_index'].get_indexer([model['entity_map'].get(address, address) for address in batch])
+			stored = [address for address, row in zip(batch, rows) if row >= 0]
+			embeddings = [pd.DataFrame(model['embeddings'][rows[rows >= 0]], index=stored)] if stored else []
+			cached = [address for address, row in zip(batch, rows) if row < 0 and address in scoring_cache]
+			if cached:
+				embeddings.append(pd.DataFrame([scoring_cache[address] for address in cached], index=cached))
+			unseen = [address for address, row in zip(batch, rows) if row < 0 and address not in scoring_cache]
+			computed = compute_address_embeddings(cursor, label_index, model, unseen) if unseen else pd.DataFrame()
+			scoring_cache.update(zip(computed.index, computed.values))
+			embeddings.append(computed)
+			embeddings = pd.concat(embeddings)
+			probabilities = pd.DataFrame(classifier.predict_proba(embeddings.values) if len(embeddings) > 0 else None, index=embeddings.index, columns=flag_names)
+			probabilities['Predicted'] = probabilities[flag_names].idxmax(axis=1)
+			probabilities = probabilities.reindex(batch)
+			probabilities.to_csv(OUTPUT_FOLDER + 'scoring_predictions.csv', sep=',', mode='a', header=(i == 0), index_label='address')
+			stage.add(rows=len(batch))
+		batch_time = time.time() - batch_time
+		batch_statistics = '\nBatch ' + str(i) + ': ' + str(len(batch)) + ' addresses(stored: ' + str(len(stored)) + ', cached: ' + str(len(cached)) + ', computed: ' + str(len(computed)) + ', not found: ' + str(len(batch) - len(embeddings)) + '), latency ' + str(batch_time) + ' seconds'
+		logging.info(batch_statistics)
+		statistics += batch_statistics
+	close_database(db, cursor)
+	with open(OUTPUT_FOLDER + 'scoring_statistics.txt', "w") as output_file:
+		output_file.write(statistics)
+	logging.info('Addresses scored!')
 
 #####################################################
 
 # Script execution order:
 #	1. Create execution output folder.
 #	2. Retrieve execution records dictionary.
-#	3. Generate StellarGraph object.
+#	3. Generate StellarGraph object, or the graph data in temporal mode.
 #	4. Execute Machine Learning task.
+# In scoring mode, addresses are scored using a previous execution model files instead.
+# Embedding engine is validated first, so a misconfigured execution fails before the graph retrieval.
 
+if EMBEDDING_ENGINE not in ['dgi', 'sgc']:
+	raise ValueError('Unknown embedding engine: ' + EMBEDDING_ENGINE)
 total_time = time.time()
 OUTPUT_FOLDER = create_output_folder()
-execution_records_dict = retrieve_execution_records()
-stellar_graph, node_flags = generate_graph(execution_records_dict)
-execute_graph_ML(stellar_graph, node_flags)
+if SCORING_MODE:
+	score_addresses()
+elif TEMPORAL_MODE:
+	execution_records_dict = retrieve_execution_records()
+	node_labels, edge_matrix = retrieve_graph(execution_records_dict)
+	execute_temporal_graph_ML(node_labels, edge_matrix)
+else:
+	execution_records_dict = retrieve_execution_records()
+	stellar_graph, node_flags, graph_hash, scaling = generate_graph(execution_records_dict)
+	execute_graph_ML(stellar_graph, node_flags, graph_hash, scaling)
 logging.info('Total Execution time: ' + time.strftime('%H:%M:%S', time.gmtime(time.time() - total_time)))
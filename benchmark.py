@@ -0,0 +1,386 @@
+# -------------------------------------------------------------
+#
+# This script benchmarks the pipeline scripts end to end, without requiring
+# Bitcoin blk files, a MySQL server or the original Entity-address dataset.
+# A synthetic chain and labeled address files are generated at the configured scale,
+# and each script is executed in order against a local SQLite Database stand-in:
+# parser.py -> reader.py -> transactions_retriever.py -> analyzer.py
+# Each script stage wall time, throughput and peak memory are recorded,
+# throughput being measured in chain transactions, retrieved transactions or graph nodes and edges per stage,
+# along with its instrumentation metrics, and compared against the stored baselines,
+# flagging regressions beyond the configured threshold.
+#
+# Usage:
+#	python benchmark.py --scale 10k
+#	python benchmark.py --scale 1M --update-baselines
+#
+# This source code is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this source code. If not, see <http://www.gnu.org/licenses/>.
+# --------------------------------------------------------------
+
+import os, sys, time, json, random, hashlib, struct, sqlite3, argparse, logging, runpy, subprocess, types, re
+from datetime import datetime
+
+# Execution configuration.
+logging.basicConfig(format='%(asctime)s.%(msecs)06d: %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
+
+# Benchmark scales, as number of synthetic chain transactions.
+SCALES = {'10k': 10000, '1M': 1000000, '10M': 10000000}
+
+# Synthetic chain configuration.
+TRANSACTIONS_PER_BLOCK = 500
+BLOCKS_PER_FILE = 20
+ADDRESSES_RATIO = 0.5 # address pool size per transaction
+LABELED_ADDRESSES_RATIO = 0.1 # labeled addresses per address pool address
+UTXO_POOL_SIZE = 100000 # spendable outputs kept in memory
+CHAIN_START = datetime(2010, 1, 1).timestamp()
+CHAIN_END = datetime(2018, 3, 31).timestamp()
+SEED = 42
+
+# Address files sampling configuration of transactions_retriever.py, scaled with the chain,
+# so the retrieved transactions and the analyzer graph grow with the benchmark scale.
+SAMPLED_ADDRESSES_RATIO = 0.001 # sampled addresses per address file, per chain transaction
+MALICIOUS_SAMPLED_ADDRESSES_FACTOR = 30 # malicious addresses file sampling, relative to the other files
+
+# Original dataset files, matching transactions_retriever.py address positions.
+ADDRESS_FILES = [['Addresses/Exchanges_full_detailed.csv', 5], ['Addresses/Gambling_full_detailed.csv', 4], ['Addresses/Historic_full_detailed.csv', 4], ['Addresses/Malicious_addresses.csv', 0], ['Addresses/Mining_full_detailed.csv', 4], ['Addresses/Services_full_detailed.csv', 4]]
+
+# Benchmark execution paths and parameters.
+SCRIPTS_FOLDER = os.path.dirname(os.path.abspath(__file__)) + '/'
+BENCHMARK_FOLDER = 'Benchmarks/'
+BASELINES_FILE = SCRIPTS_FOLDER + 'benchmark_baselines.json'
+STAGES = ['parser.py', 'reader.py', 'transactions_retriever.py', 'analyzer.py']
+REGRESSION_THRESHOLD = 0.2 # allowed relative increase over the baseline
+REGRESSION_METRICS = ['wall_time', 'peak_rss']
+
+# Database stand-in indexes, created along with each table.
+DATABASE_INDEXES = {'tx': ['txid'], 'txin': ['consume_txid', 'output_txid, vout'], 'txout': ['output_txid, vout', 'address']}
+
+def sha256d(data):
+	return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+def varint(n):
+	if n < 253:
+		return struct.pack('<B', n)
+	if n <= 0xffff:
+		return b'\xfd' + struct.pack('<H', n)
+	if n <= 0xffffffff:
+		return b'\xfe' + struct.pack('<I', n)
+	return b'\xff' + struct.pack('<Q', n)
+
+# Encodes a P2PKH mainnet address, given its public key hash.
+def p2pkh_address(pubkey_hash):
+	alphabet = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+	payload = b'\x00' + pubkey_hash
+	payload += sha256d(payload)[:4]
+	n = int.from_bytes(payload, 'big')
+	address = ''
+	while n > 0:
+		n, remainder = divmod(n, 58)
+		address = alphabet[remainder] + address
+	leading_zeros = len(payload) - len(payload.lstrip(b'\x00'))
+	return '1' * leading_zeros + address
+
+# Serializes a legacy transaction.
+# Inputs are (txid, vout) tuples of spent outputs, or None for a coinbase input,
+# while outputs are (public key hash, value) tuples paid using P2PKH scripts.
+def create_transaction(rng, inputs, outputs):
+	raw = struct.pack('<I', 1) + varint(len(inputs))
+	for spent_output in inputs:
+		if spent_output is None:
+			script_sig = b'\x04' + rng.getrandbits(32).to_bytes(4, 'little')
+			raw += b'\x00' * 32 + struct.pack('<I', 0xffffffff)
+		else:
+			script_sig = b'\x47' + rng.getrandbits(568).to_bytes(71, 'little') + b'\x21' + rng.getrandbits(264).to_bytes(33, 'little')
+			raw += spent_output[0] + struct.pack('<I', spent_output[1])
+		raw += varint(len(script_sig)) + script_sig + struct.pack('<I', 0xffffffff)
+	raw += varint(len(outputs))
+	for pubkey_hash, value in outputs:
+		script_pubkey = b'\x76\xa9\x14' + pubkey_hash + b'\x88\xac'
+		raw += struct.pack('<Q', value) + varint(len(script_pubkey)) + script_pubkey
+	raw += struct.pack('<I', 0)
+	return raw
+
+# Calculates the merkle root of given transaction hashes.
+def merkle_root(hashes):
+	while len(hashes) > 1:
+		if len(hashes) % 2 == 1:
+			hashes.append(hashes[-1])
+		hashes = [sha256d(hashes[i] + hashes[i + 1]) for i in range(0, len(hashes), 2)]
+	return hashes[0]
+
+# Generates the synthetic chain blk files in given folder.
+# Each transaction spends 1-2 outputs from a bounded pool of unspent outputs,
+# or is a coinbase transaction when the pool is exhausted, and pays 1-2 addresses of the address pool.
+# Returns the number of generated blk files.
+def generate_chain(folder, transactions, address_pool, rng):
+	logging.info('Generating synthetic chain of ' + str(transactions) + ' transactions...')
+	blocks = (transactions + TRANSACTIONS_PER_BLOCK - 1) // TRANSACTIONS_PER_BLOCK
+	unspent_outputs = []
+	previous_block_hash = b'\x00' * 32
+	file_index = 0
+	blk_file = None
+	generated = 0
+	for block in range(blocks):
+		if block % BLOCKS_PER_FILE == 0:
+			if blk_file is not None:
+				blk_file.close()
+			blk_file = open(folder + 'blk' + f'{file_index:05d}' + '.dat', 'wb')
+			file_index += 1
+		block_transactions = []
+		for k in range(min(TRANSACTIONS_PER_BLOCK, transactions - generated)):
+			inputs_count = rng.randint(1, 2)
+			if len(unspent_outputs) < inputs_count:
+				inputs = [None]
+			else:
+				inputs = []
+				for j in range(inputs_count):
+					position = rng.randrange(len(unspent_outputs))
+					unspent_outputs[position], unspent_outputs[-1] = unspent_outputs[-1], unspent_outputs[position]
+					inputs.append(unspent_outputs.pop())
+			outputs = [(address_pool[rng.randrange(len(address_pool))], rng.randint(1000, 5000000000)) for j in range(rng.randint(1, 2))]
+			raw = create_transaction(rng, inputs, outputs)
+			txid = sha256d(raw)
+			for vout in range(len(outputs)):
+				if len(unspent_outputs) < UTXO_POOL_SIZE:
+					unspent_outputs.append((txid, vout))
+				else:
+					unspent_outputs[rng.randrange(UTXO_POOL_SIZE)] = (txid, vout)
+			block_transactions.append((txid, raw))
+		generated += len(block_transactions)
+		timestamp = int(CHAIN_START + (CHAIN_END - CHAIN_START) * block / blocks)
+		header = struct.pack('<I', 1) + previous_block_hash + merkle_root([txid for txid, raw in block_transactions]) + struct.pack('<III', timestamp, 0x1d00ffff, rng.getrandbits(32))
+		block_data = header + varint(len(block_transactions)) + b''.join(raw for txid, raw in block_transactions)
+		blk_file.write(bytes.fromhex('f9beb4d9') + struct.pack('<I', len(block_data)) + block_data)
+		previous_block_hash = sha256d(header)
+	blk_file.close()
+	logging.info('Synthetic chain generated! Files: ' + str(file_index))
+	return file_index
+
+# Generates the labeled address files, using the original dataset files layout.
+# Labeled addresses are split evenly between the dataset files.
+def generate_address_files(folder, address_pool, rng):
+	logging.info('Generating labeled address files...')
+	labeled = rng.sample(address_pool, max(len(ADDRESS_FILES), int(len(address_pool) * LABELED_ADDRESSES_RATIO)))
+	for i, (file, address_position) in enumerate(ADDRESS_FILES):
+		with open(folder + file, 'w') as address_file:
+			address_file.write(','.join('column_' + str(j) for j in range(address_position + 1)) + '\n')
+			for pubkey_hash in labeled[i::len(ADDRESS_FILES)]:
+				address_file.write(',' * address_position + p2pkh_address(pubkey_hash) + '\n')
+	logging.info('Labeled address files generated! Labeled addresses: ' + str(len(labeled)))
+
+# Class mapping a MySQL connection to the SQLite Database stand-in file,
+# attached as the btc schema so that scripts queries run unchanged.
+class SQLite_Connection:
+	def __init__(self, database_file):
+		self.connection = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_DECLTYPES)
+		self.connection.execute('ATTACH DATABASE ? AS btc', (database_file,))
+
+	def cursor(self):
+		return SQLite_Cursor(self.connection)
+
+	def commit(self):
+		self.connection.commit()
+
+	def is_connected(self):
+		return self.connection is not None
+
+	def close(self):
+		self.connection.close()
+		self.connection = None
+
+# Class mapping a MySQL cursor to the SQLite Database stand-in.
+# MySQL specific statements are translated, or ignored when not applicable.
+class SQLite_Cursor:
+	def __init__(self, connection):
+		self.connection = connection
+		self.cursor = connection.cursor()
+
+	def execute(self, query):
+		if query.startswith('CREATE DATABASE') or query.startswith('RESTART'):
+			return
+		table = re.match(r'CREATE TABLE IF NOT EXISTS (\w+)', query)
+		if table is not None:
+			self.cursor.execute(query.replace(table.group(0), 'CREATE TABLE IF NOT EXISTS btc.' + table.group(1), 1))
+			for i, columns in enumerate(DATABASE_INDEXES.get(table.group(1), [])):
+				self.cursor.execute('CREATE INDEX IF NOT EXISTS btc.' + table.group(1) + '_index_' + str(i) + ' ON ' + table.group(1) + ' (' + columns + ')')
+			return
+		self.cursor.execute(query)
+
+	def fetchmany(self, size):
+		return self.cursor.fetchmany(size)
+
+	def __iter__(self):
+		return iter(self.cursor)
+
+# Runs a pipeline script in the current process, replacing the MySQL connector with the SQLite Database stand-in.
+def run_stage(script):
+	database_file = os.environ['BTC_BENCHMARK_DATABASE']
+	sqlite3.register_converter('DATETIME', lambda value: datetime.fromisoformat(value.decode()))
+	connector = types.ModuleType('mysql.connector')
+	connector.connect = lambda host=None, user=None, password=None, database=None: SQLite_Connection(database_file)
+	mysql = types.ModuleType('mysql')
+	mysql.connector = connector
+	sys.modules['mysql'] = mysql
+	sys.modules['mysql.connector'] = connector
+	sys.path.insert(0, SCRIPTS_FOLDER)
+	sys.argv = [SCRIPTS_FOLDER + script]
+	runpy.run_path(SCRIPTS_FOLDER + script, run_name='__main__')
+
+# Parses a stage metrics file, aggregating its instrumentation records per stage name.
+def read_metrics_file(file):
+	summary = {}
+	stages = {}
+	if not os.path.exists(file):
+		return summary, stages
+	with open(file) as metrics_file:
+		for line in metrics_file:
+			record = json.loads(line)
+			if record['stage'] == 'run':
+				summary = record
+				continue
+			stage = stages.setdefault(record['stage'], {'calls':0, 'wall_time':0.0, 'cpu_time':0.0, 'wait_time':0.0, 'rows':0, 'bytes':0})
+			stage['calls'] += 1
+			for metric in ['wall_time', 'cpu_time', 'wait_time', 'rows', 'bytes']:
+				stage[metric] += record[metric]
+			for field in ['nodes', 'edges']:
+				if field in record:
+					stage[field] = record[field]
+	return summary, stages
+
+# Computes a stage throughput, using the units each script processes:
+# parser.py and reader.py chain transactions, transactions_retriever.py retrieved transactions
+# and analyzer.py graph nodes and edges.
+def stage_throughput(work_folder, script, wall_time, transactions, stages):
+	if script == 'transactions_retriever.py':
+		retrieved = 0
+		if os.path.exists(work_folder + 'Generated_Files/transactions.csv'):
+			with open(work_folder + 'Generated_Files/transactions.csv') as transactions_file:
+				retrieved = max(0, sum(1 for line in transactions_file) - 1)
+		return {'retrieved_transactions':retrieved, 'retrieved_transactions_per_second':retrieved / wall_time}
+	if script == 'analyzer.py':
+		graph = stages.get('write_graph_file', {})
+		if 'nodes' not in graph:
+			return {'graph_nodes':None, 'graph_edges':None}
+		return {'graph_nodes':graph['nodes'], 'graph_edges':graph['edges'], 'nodes_per_second':graph['nodes'] / wall_time, 'edges_per_second':graph['edges'] / wall_time}
+	return {'transactions':transactions, 'transactions_per_second':transactions / wall_time}
+
+# Executes a pipeline script in a dedicated process, within the benchmark folder, and records its metrics.
+# Address files sampling of transactions_retriever.py is scaled with the chain transactions.
+def execute_stage(work_folder, script, blk_files, transactions):
+	logging.info('Executing stage: ' + script)
+	metrics_file = os.path.abspath(work_folder + script.replace('.py', '') + '_metrics.jsonl')
+	address_limit = max(1, int(transactions * SAMPLED_ADDRESSES_RATIO))
+	env = dict(os.environ)
+	env.update({'BTC_BENCHMARK_DATABASE':os.path.abspath(work_folder + 'btc.sqlite'), 'BTC_METRICS_FILE':metrics_file, 'BTC_BLK_FOLDER':os.path.abspath(work_folder + 'blocks') + '/', 'BTC_PARSER_OUTPUT_FOLDER':'parser_output/', 'BTC_READER_START_INDEX':'0', 'BTC_READER_END_INDEX':str(blk_files), 'BTC_RETRIEVER_ADDRESS_LIMIT':str(address_limit), 'BTC_RETRIEVER_MALICIOUS_ADDRESS_LIMIT':str(address_limit * MALICIOUS_SAMPLED_ADDRESSES_FACTOR)})
+	stage_time = time.time()
+	with open(work_folder + script.replace('.py', '') + '.log', 'w') as log_file:
+		result = subprocess.run([sys.executable, SCRIPTS_FOLDER + 'benchmark.py', '--run-stage', script], cwd=work_folder, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+	wall_time = time.time() - stage_time
+	summary, stages = read_metrics_file(metrics_file)
+	stage_result = {'returncode':result.returncode, 'wall_time':wall_time, 'throughput':stage_throughput(work_folder, script, wall_time, transactions, stages), 'peak_rss':summary.get('process_peak_rss'), 'stages':stages}
+	logging.info('Stage ' + script + ' finished with code ' + str(result.returncode) + '! Elapsed time: ' + time.strftime('%H:%M:%S', time.gmtime(wall_time)))
+	return stage_result
+
+# Compares the stage results against their baselines, returning the regressions found.
+def find_regressions(results, baselines):
+	regressions = []
+	for script, result in results.items():
+		baseline = baselines.get(script)
+		if baseline is None:
+			continue
+		for metric in REGRESSION_METRICS:
+			if result.get(metric) is None or baseline.get(metric) is None:
+				continue
+			if result[metric] > baseline[metric] * (1 + REGRESSION_THRESHOLD):
+				regressions.append(script + ' ' + metric + ': ' + str(result[metric]) + ' (baseline: ' + str(baseline[metric]) + ')')
+	return regressions
+
+# Given a benchmark scale:
+#	1. Create the benchmark folder.
+#	2. Generate the synthetic chain and labeled address files.
+#	3. Execute each pipeline stage in order, stopping on a failed stage.
+#	4. Extract stage results to a file.
+#	5. Compare results against the stored baselines, or update them.
+# Failed stages are returned as regressions, and baselines are never updated from a failed run.
+def run_benchmark(scale, update_baselines):
+	transactions = SCALES[scale]
+	work_folder = BENCHMARK_FOLDER + scale + '_' + datetime.now().strftime("%Y_%m_%d_%H_%M_%S") + '/'
+	logging.info('Creating benchmark folder ' + work_folder + '...')
+	for folder in ['blocks', 'parser_output', 'Addresses', 'Generated_Files', 'Executions']:
+		os.makedirs(work_folder + folder)
+
+	rng = random.Random(SEED)
+	address_pool = [rng.getrandbits(160).to_bytes(20, 'big') for i in range(max(len(ADDRESS_FILES), int(transactions * ADDRESSES_RATIO)))]
+	blk_files = generate_chain(work_folder + 'blocks/', transactions, address_pool, rng)
+	generate_address_files(work_folder, address_pool, rng)
+
+	results = {}
+	for script in STAGES:
+		results[script] = execute_stage(work_folder, script, blk_files, transactions)
+		if results[script]['returncode'] != 0:
+			logging.info('Stage ' + script + ' failed, see ' + work_folder + script.replace('.py', '') + '.log')
+			break
+	with open(work_folder + 'benchmark_results.json', 'w') as results_file:
+		json.dump({'scale':scale, 'transactions':transactions, 'results':results}, results_file, indent=4)
+
+	report = 'Benchmark results(' + scale + '):'
+	for script, result in results.items():
+		report += '\n' + script + ': code ' + str(result['returncode']) + ', wall time ' + str(round(result['wall_time'], 3)) + ' seconds, ' + ', '.join(name + ' ' + str(round(value, 1) if isinstance(value, float) else value) for name, value in result['throughput'].items()) + ', peak memory ' + str(result['peak_rss']) + ' bytes'
+	logging.info(report)
+
+	failures = [script + ': failed with code ' + str(result['returncode']) for script, result in results.items() if result['returncode'] != 0]
+	if failures:
+		logging.info('Failed stages found:\n' + '\n'.join(failures))
+		if update_baselines:
+			logging.info('Baselines not updated, as not all stages succeeded.')
+		return failures
+
+	baselines = {}
+	if os.path.exists(BASELINES_FILE):
+		with open(BASELINES_FILE) as baselines_file:
+			baselines = json.load(baselines_file)
+	if update_baselines:
+		baselines.setdefault(scale, {}).update({script:{metric:result[metric] for metric in REGRESSION_METRICS} for script, result in results.items()})
+		with open(BASELINES_FILE, 'w') as baselines_file:
+			json.dump(baselines, baselines_file, indent=4, sort_keys=True)
+		logging.info('Baselines updated: ' + BASELINES_FILE)
+		return []
+	if scale not in baselines:
+		logging.info('No baselines stored for scale ' + scale + ', use --update-baselines to store them.')
+		return []
+	regressions = find_regressions(results, baselines[scale])
+	if regressions:
+		logging.info('Regressions beyond ' + str(REGRESSION_THRESHOLD * 100) + '% found:\n' + '\n'.join(regressions))
+	else:
+		logging.info('No regressions found!')
+	return regressions
+
+#####################################################
+
+# Script execution order:
+#	1. Parse command line arguments.
+#	2. Execute a single stage, when invoked by the benchmark itself, or the whole benchmark.
+
+parser = argparse.ArgumentParser(description='End to end pipeline benchmark, using a synthetic chain and a SQLite Database stand-in.')
+parser.add_argument('--scale', choices=list(SCALES), default='10k', help='synthetic chain scale')
+parser.add_argument('--update-baselines', action='store_true', help='store the results as the scale baselines')
+parser.add_argument('--run-stage', help=argparse.SUPPRESS)
+arguments = parser.parse_args()
+if arguments.run_stage:
+	run_stage(arguments.run_stage)
+else:
+	total_time = time.time()
+	regressions = run_benchmark(arguments.scale, arguments.update_baselines)
+	logging.info('Total Execution time: ' + time.strftime('%H:%M:%S', time.gmtime(time.time() - total_time)))
+	sys.exit(1 if regressions else 0)
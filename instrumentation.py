@@ -0,0 +1,180 @@
+# -------------------------------------------------------------
+#
+# This module provides the shared instrumentation of the pipeline scripts.
+# Stages are measured using a context manager, or a decorator, recording their
+# wall and CPU time, wait time(wall time not spent on CPU, e.g. Database waits),
+# processed rows and bytes throughput, along with the RSS memory, sampled during each stage.
+# Optionally, stages can be profiled using cProfile and tracemalloc.
+# Each stage is exported as a JSON line to the run metrics file.
+#
+# Configuration can be overridden using environment variables:
+#	BTC_METRICS_FOLDER: metrics files output folder.
+#	BTC_METRICS_FILE: metrics file path, used instead of a new file per run.
+#	BTC_PROFILE_STAGES: comma separated stage names to profile using cProfile, or * for all stages.
+#	BTC_TRACE_MEMORY: set to 1 to trace Python memory allocations peak per stage using tracemalloc.
+#	BTC_MEMORY_SAMPLE_INTERVAL: stage RSS memory sampling interval in seconds, or 0 to sample only at stage start and stop.
+#
+# This source code is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this source code. If not, see <http://www.gnu.org/licenses/>.
+# --------------------------------------------------------------
+
+import os, sys, time, json, atexit, threading, functools, cProfile, tracemalloc
+from datetime import datetime
+try:
+	import resource
+except ImportError:
+	resource = None # Not available on Windows.
+
+# Instrumentation configuration.
+METRICS_FOLDER = os.environ.get('BTC_METRICS_FOLDER', 'Metrics/')
+METRICS_FILE = os.environ.get('BTC_METRICS_FILE')
+PROFILE_STAGES = [stage for stage in os.environ.get('BTC_PROFILE_STAGES', '').split(',') if stage]
+TRACE_MEMORY = os.environ.get('BTC_TRACE_MEMORY') == '1'
+MEMORY_SAMPLE_INTERVAL = float(os.environ.get('BTC_MEMORY_SAMPLE_INTERVAL', '0.1')) # seconds
+
+# Run identification.
+SCRIPT = os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'interactive'
+RUN_ID = SCRIPT + '_' + datetime.now().strftime("%Y_%m_%d_%H_%M_%S") + '_' + str(os.getpid())
+RUN_START = time.time()
+
+# Metrics file writing state.
+_lock = threading.Lock()
+_metrics_file = None
+_profiling = False
+_profile_counter = 0
+
+# Returns the current resident memory of the process in bytes.
+# On systems without /proc, peak resident memory is returned instead.
+def current_memory():
+	try:
+		with open('/proc/self/statm') as statm:
+			return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except (OSError, ValueError, AttributeError):
+		return peak_memory()
+
+# Returns the peak resident memory of the process in bytes(ru_maxrss is reported in KB on Linux and bytes on macOS).
+def peak_memory():
+	if resource is None:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak if sys.platform == 'darwin' else peak * 1024
+
+# Writes a record as a JSON line to the run metrics file, which is created on first use.
+def write_record(record):
+	global _metrics_file
+	record = dict({'run':RUN_ID, 'script':SCRIPT, 'time':time.time()}, **record)
+	with _lock:
+		if _metrics_file is None:
+			file = METRICS_FILE
+			if file is None:
+				os.makedirs(METRICS_FOLDER, exist_ok=True)
+				file = METRICS_FOLDER + RUN_ID + '.jsonl'
+			_metrics_file = open(file, 'a')
+		_metrics_file.write(json.dumps(record, default=str) + '\n')
+		_metrics_file.flush()
+
+# Writes the run summary record on exit, when any stage was recorded.
+def write_run_summary():
+	if _metrics_file is not None:
+		write_record({'stage':'run', 'wall_time':time.time() - RUN_START, 'cpu_time':time.process_time(), 'process_peak_rss':peak_memory()})
+		_metrics_file.close()
+
+atexit.register(write_run_summary)
+
+# Class measuring a pipeline stage.
+# Used as a context manager, or using explicit start() and stop() calls.
+# Processed rows and bytes are counted using add(), while extra fields are exported as given.
+# Stage peak memory is sampled by a background thread, as the process peak memory includes previous stages.
+class Stage:
+	def __init__(self, name, **fields):
+		self.name = name
+		self.fields = fields
+		self.rows = 0
+		self.bytes = 0
+		self.profiler = None
+		self.sampler = None
+
+	def add(self, rows=0, bytes=0):
+		self.rows += rows
+		self.bytes += bytes
+
+	def sample_memory(self):
+		while not self.sampling_stopped.wait(MEMORY_SAMPLE_INTERVAL):
+			self.peak_rss = max(self.peak_rss, current_memory())
+
+	def start(self):
+		global _profiling
+		if TRACE_MEMORY:
+			if not tracemalloc.is_tracing():
+				tracemalloc.start()
+			if hasattr(tracemalloc, 'reset_peak'):
+				tracemalloc.reset_peak()
+		# Only one profiler can be active, so nested stages are included in the outer stage profile.
+		with _lock:
+			if (self.name in PROFILE_STAGES or '*' in PROFILE_STAGES) and not _profiling:
+				_profiling = True
+				self.profiler = cProfile.Profile()
+		if self.profiler is not None:
+			self.profiler.enable()
+		self.start_rss = current_memory()
+		self.peak_rss = self.start_rss
+		if MEMORY_SAMPLE_INTERVAL > 0:
+			self.sampling_stopped = threading.Event()
+			self.sampler = threading.Thread(target=self.sample_memory, daemon=True)
+			self.sampler.start()
+		self.start_cpu_time = time.process_time()
+		self.start_time = time.time()
+		return self
+
+	def stop(self, error=None):
+		global _profiling, _profile_counter
+		wall_time = time.time() - self.start_time
+		cpu_time = time.process_time() - self.start_cpu_time
+		if self.sampler is not None:
+			self.sampling_stopped.set()
+			self.sampler.join()
+			self.sampler = None
+		rss = current_memory()
+		record = {'stage':self.name, 'wall_time':wall_time, 'cpu_time':cpu_time, 'wait_time':max(0.0, wall_time - cpu_time), 'rows':self.rows, 'bytes':self.bytes, 'rows_per_second':self.rows / wall_time if wall_time > 0 else None, 'bytes_per_second':self.bytes / wall_time if wall_time > 0 else None, 'start_rss':self.start_rss, 'rss':rss, 'stage_peak_rss':max(self.peak_rss, rss), 'process_peak_rss':peak_memory()}
+		if self.profiler is not None:
+			self.profiler.disable()
+			with _lock:
+				_profile_counter += 1
+				profile_file = METRICS_FOLDER + RUN_ID + '_' + self.name + '_' + str(_profile_counter) + '.prof'
+				_profiling = False
+			os.makedirs(METRICS_FOLDER, exist_ok=True)
+			self.profiler.dump_stats(profile_file)
+			record['profile_file'] = profile_file
+		if TRACE_MEMORY and tracemalloc.is_tracing():
+			record['traced_peak'] = tracemalloc.get_traced_memory()[1]
+		if error is not None:
+			record['error'] = repr(error)
+		record.update(self.fields)
+		write_record(record)
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.stop(exc_value)
+		return False
+
+# Decorator measuring each call of a function as a stage, named after the function unless a name is given.
+def timed(name=None):
+	def decorator(function):
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			with Stage(name or function.__name__):
+				return function(*args, **kwargs)
+		return wrapper
+	return decorator
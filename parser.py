@@ -26,6 +26,7 @@
 import os
 import datetime
 import hashlib
+import instrumentation
 from btcpy.setup import setup
 from btcpy.structs.script import ScriptSig
 from btcpy.structs.address import P2pkhAddress, P2wpkhAddress
@@ -91,8 +92,9 @@ def read_varint(file):
 
 setup('mainnet')
 
-dirA = '{path to Bitcoin blk files folder}'
-dirB = 'parser_output/'
+# Folders can be overridden using environment variables, e.g. by benchmark.py.
+dirA = os.environ.get('BTC_BLK_FOLDER', '{path to Bitcoin blk files folder}')
+dirB = os.environ.get('BTC_PARSER_OUTPUT_FOLDER', 'parser_output/')
 
 fList = os.listdir(dirA)
 fList = [x for x in fList if (x.endswith('.dat') and x.startswith('blk'))]
@@ -108,6 +110,8 @@ for i in fList:
 	f = open(t,'rb')
 	tmpHex = ''
 	fSize = os.path.getsize(t)
+	stage = instrumentation.Stage('parse_blk_file', file=nameSrc).start()
+	stage.add(bytes=fSize)
 	while f.tell() != fSize:
 		tmpHex = read_bytes(f,4)
 		tmpHex = read_bytes(f,4)
@@ -256,12 +260,17 @@ for i in fList:
 			tx_hashes.append(tmpHex)
 			tmpHex = ''; RawTX = ''
 		a += 1
+		stage.add(rows=txCount)
 		tx_hashes = [bytes.fromhex(h) for h in tx_hashes]
 		tmpHex = merkle_root(tx_hashes).hex().upper()
 		if tmpHex != MerkleRoot:
 			print ('Merkle roots does not match! >',MerkleRoot,tmpHex)
 	f.close()
-	f = open(dirB + nameRes,'w')
-	for j in resList:
-		f.write(j + '\n')
-	f.close()
+	stage.fields['blocks'] = a
+	stage.stop()
+	with instrumentation.Stage('write_output_file', file=nameRes) as stage:
+		f = open(dirB + nameRes,'w')
+		for j in resList:
+			f.write(j + '\n')
+		stage.add(rows=len(resList), bytes=f.tell())
+		f.close()
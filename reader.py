@@ -21,7 +21,9 @@
 
 import time
 import csv
+import os
 import mysql.connector as mysql
+import instrumentation
 
 # Class mapping `tx` DB records.
 class TX:
@@ -93,9 +95,11 @@ def close_database(db):
 def parse_file(db, file):
 	start_time = time.time()
 	print ('Start reading file ' + str(file) + ' at: ' + time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(start_time)))
-	with open(file, newline='') as f:
-		reader = csv.reader(f)
-		records = list(reader)
+	with instrumentation.Stage('read_file', file=file) as stage:
+		with open(file, newline='') as f:
+			reader = csv.reader(f)
+			records = list(reader)
+		stage.add(rows=len(records), bytes=os.path.getsize(file))
 
 	tx_list = []
 	txin_list = []
@@ -111,33 +115,40 @@ def parse_file(db, file):
 			txout = TXOUT(record[1], record[2], record[3], record[4].replace(';', ''))
 			txout_list.append(txout)
 	
+	# Insert stages wait time corresponds to the Database wait time.
 	commit_counter = 0;
-	for tx in tx_list:
-		tx.insert_record(db)
-		if (commit_counter == 10000):
-			db.commit();
-			commit_counter = 0
-		else:
-			commit_counter += 1
-	db.commit()
+	with instrumentation.Stage('insert_tx_records', file=file) as stage:
+		for tx in tx_list:
+			tx.insert_record(db)
+			if (commit_counter == 10000):
+				db.commit();
+				commit_counter = 0
+			else:
+				commit_counter += 1
+		db.commit()
+		stage.add(rows=len(tx_list))
 
-	for txin in txin_list:
-		txin.insert_record(db)
-		if (commit_counter == 10000):
-			db.commit();
-			commit_counter = 0
-		else:
-			commit_counter += 1
-	db.commit()
+	with instrumentation.Stage('insert_txin_records', file=file) as stage:
+		for txin in txin_list:
+			txin.insert_record(db)
+			if (commit_counter == 10000):
+				db.commit();
+				commit_counter = 0
+			else:
+				commit_counter += 1
+		db.commit()
+		stage.add(rows=len(txin_list))
 		
-	for txout in txout_list:
-		txout.insert_record(db)
-		if (commit_counter == 10000):
-			db.commit();
-			commit_counter = 0
-		else:
-			commit_counter += 1
-	db.commit()
+	with instrumentation.Stage('insert_txout_records', file=file) as stage:
+		for txout in txout_list:
+			txout.insert_record(db)
+			if (commit_counter == 10000):
+				db.commit();
+				commit_counter = 0
+			else:
+				commit_counter += 1
+		db.commit()
+		stage.add(rows=len(txout_list))
 
 	print ('Finished reading file ' + str(file) + '! Elapsed time: ' + time.strftime('%H:%M:%S', time.gmtime(time.time() - start_time)))
 
@@ -148,9 +159,10 @@ def parse_file(db, file):
 #	2. Parse files with index in specific range(implemented for batch processing).
 #	3. Close DB connection.
 	
-dir = 'parser_output/'
-start_index = 2364
-end_index = 2400
+# Values can be overridden using environment variables, e.g. by benchmark.py.
+dir = os.environ.get('BTC_PARSER_OUTPUT_FOLDER', 'parser_output/')
+start_index = int(os.environ.get('BTC_READER_START_INDEX', 2364))
+end_index = int(os.environ.get('BTC_READER_END_INDEX', 2400))
 db = init_database()
 for x in range(start_index, end_index):
 	file = dir + 'blk' + f'{x:05d}' + '.txt'
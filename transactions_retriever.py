@@ -22,20 +22,27 @@
 # along with this source code. If not, see <http://www.gnu.org/licenses/>.
 # --------------------------------------------------------------
 
-import logging, time, csv, random
+import os, logging, time, csv, random
+from enum import Enum
 import mysql.connector as mysql
+import instrumentation
+import numpy as np
+import pandas as pd
 
 # Execution configuration.
 logging.basicConfig(format='%(asctime)s.%(msecs)07d: %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
 
 # Original dataset files configuration.
 # file = ['file_path', address_position, address_limit]
-EXCHANGES_ADDRESSES_FILE = ['Addresses/Exchanges_full_detailed.csv', 5, 10]
-GAMBLING_ADDRESSES_FILE = ['Addresses/Gambling_full_detailed.csv', 4, 10]
-HISTORIC_ADDRESSES_FILE = ['Addresses/Historic_full_detailed.csv', 4, 10]
-MALICIOUS_ADDRESSES_FILE = ['Addresses/Malicious_addresses.csv', 0, 300]
-MINING_ADDRESSES_FILE = ['Addresses/Mining_full_detailed.csv', 4, 10]
-SERVICES_ADDRESSES_FILE = ['Addresses/Services_full_detailed.csv', 4, 10]
+# Address limits can be overridden using environment variables, e.g. by benchmark.py.
+ADDRESS_LIMIT = int(os.environ.get('BTC_RETRIEVER_ADDRESS_LIMIT', 10))
+MALICIOUS_ADDRESS_LIMIT = int(os.environ.get('BTC_RETRIEVER_MALICIOUS_ADDRESS_LIMIT', 300))
+EXCHANGES_ADDRESSES_FILE = ['Addresses/Exchanges_full_detailed.csv', 5, ADDRESS_LIMIT]
+GAMBLING_ADDRESSES_FILE = ['Addresses/Gambling_full_detailed.csv', 4, ADDRESS_LIMIT]
+HISTORIC_ADDRESSES_FILE = ['Addresses/Historic_full_detailed.csv', 4, ADDRESS_LIMIT]
+MALICIOUS_ADDRESSES_FILE = ['Addresses/Malicious_addresses.csv', 0, MALICIOUS_ADDRESS_LIMIT]
+MINING_ADDRESSES_FILE = ['Addresses/Mining_full_detailed.csv', 4, ADDRESS_LIMIT]
+SERVICES_ADDRESSES_FILE = ['Addresses/Services_full_detailed.csv', 4, ADDRESS_LIMIT]
 
 # Database queries used to retrieve the dataset.
 # Using this queries, all transactions related to given address list are retrieved.
@@ -50,6 +57,16 @@ HISTORIC_ADDRESSES_CSV_FILE = 'Generated_Files/historic_addresses.csv'
 MALICIOUS_ADDRESSES_CSV_FILE = 'Generated_Files/malicious_addresses.csv'
 MINING_ADDRESSES_CSV_FILE = 'Generated_Files/mining_addresses.csv'
 SERVICES_ADDRESSES_CSV_FILE = 'Generated_Files/services_addresses.csv'
+LABEL_INDEX_FILE = 'Generated_Files/label_index.npz'
+
+# Utility class used for mapping address categories to integers, matching analyzer.py Node_Flag values.
+class Address_Category(Enum):
+	EXCHANGES = 2
+	GAMBLING = 3
+	HISTORIC = 4
+	MALICIOUS = 5
+	MINING = 6
+	SERVICES = 7
 
 # Parses a csv file, using the file configuration to identify address position and address limit.
 def read_csv_file(file):
@@ -63,7 +80,7 @@ def read_csv_file(file):
 			if row[file[1]] not in addresses:
 				addresses.add(row[file[1]])
 	logging.info('Addresses found: ' + str(len(addresses)))
-	random_addresses = random.sample(addresses, file[2]) if len(addresses) > file[2] else list(addresses)
+	random_addresses = random.sample(list(addresses), file[2]) if len(addresses) > file[2] else list(addresses)
 	return random_addresses, addresses
 
 # Initializes a connection with the MySQL Database.
@@ -90,12 +107,14 @@ def close_database(db, cursor):
 def execute_query(transactions, cursor, query, label):	
 	logging.info('Executing: ' + label)
 	query_time = time.time()
-	cursor.execute(query)
-	count = 0
-	for result in cursor:		
-		if result[0] not in transactions:
-			transactions.add(result[0])
-		count += 1
+	with instrumentation.Stage('execute_query', label=label) as stage:
+		cursor.execute(query)
+		count = 0
+		for result in cursor:		
+			if result[0] not in transactions:
+				transactions.add(result[0])
+			count += 1
+		stage.add(rows=count)
 	logging.info('Finished executing query (' + str(count) + ' records) ! Elapsed time: ' + time.strftime('%H:%M:%S', time.gmtime(time.time() - query_time)))
 
 # Generates an output CSV file.
@@ -107,6 +126,17 @@ def generate_csv_file(csv_file, header, records):
 			file.write(record + '\n')
 	logging.info('File generated!')
 
+# Generates the label index file used by analyzer.py for labeling graph nodes.
+# Index contains the sorted 64-bit hashes of all category addresses and their int8 category.
+# Categories are given in priority order, so addresses found in multiple categories keep the first one.
+def generate_label_index_file(label_index_file, categories):
+	logging.info('Generating label index file: ' + label_index_file)
+	hashes = np.concatenate([pd.util.hash_array(np.array(list(addresses), dtype=object)) for addresses, category in categories])
+	codes = np.concatenate([np.full(len(addresses), category.value, dtype=np.int8) for addresses, category in categories])
+	hashes, first_positions = np.unique(hashes, return_index=True)
+	np.savez(label_index_file, hashes=hashes, categories=codes[first_positions])
+	logging.info('Label index file generated! Indexed addresses: ' + str(len(hashes)))
+
 #####################################################
 
 # Script execution order:
@@ -114,6 +144,7 @@ def generate_csv_file(csv_file, header, records):
 #	2. Retrieve all transactions of the address sample from the Database.
 #	3. Generating a CSV file containing the retrieved transactions.
 #	4. Generate a CSV file containing the address list for each original dataset file to a more usable format.
+#	5. Generate the label index file of all dataset addresses.
 
 total_time = time.time()
 logging.info('Retrieving address records...')
@@ -150,4 +181,5 @@ generate_csv_file(HISTORIC_ADDRESSES_CSV_FILE, 'address', historic_addresses)
 generate_csv_file(MALICIOUS_ADDRESSES_CSV_FILE, 'address', malicious_addresses)
 generate_csv_file(MINING_ADDRESSES_CSV_FILE, 'address', mining_addresses)
 generate_csv_file(SERVICES_ADDRESSES_CSV_FILE, 'address', services_addresses)
+generate_label_index_file(LABEL_INDEX_FILE, [(exchanges_addresses, Address_Category.EXCHANGES), (gambling_addresses, Address_Category.GAMBLING), (historic_addresses, Address_Category.HISTORIC), (malicious_addresses, Address_Category.MALICIOUS), (mining_addresses, Address_Category.MINING), (services_addresses, Address_Category.SERVICES)])
 logging.info('Total Execution time: ' + time.strftime('%H:%M:%S', time.gmtime(time.time() - total_time)))